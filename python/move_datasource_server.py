@@ -21,15 +21,24 @@
 
 from version import VERSION
 import requests # Contains methods used to make HTTP requests
-import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+try:
+    from lxml import etree as ET # Contains methods used to build and parse XML (libxml2-backed)
+except ImportError:
+    import xml.etree.ElementTree as ET # Falls back to the standard library parser
 import sys
 import re
-import math
 import getpass
+from xml.sax.saxutils import quoteattr # Escapes values placed in XML attributes
 import os
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote  # Python 2.7
 
 # The following packages are used to build a multi-part/mixed request.
 # They are contained in the 'requests' library
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from requests.packages.urllib3.fields import RequestField
 from requests.packages.urllib3.filepost import encode_multipart_formdata
 
@@ -42,12 +51,29 @@ from requests.packages.urllib3.filepost import encode_multipart_formdata
 # or 'http://tableau.com/api' for Tableau Server 9.1 or later
 xmlns = {'t': 'http://tableau.com/api'}
 
+# Request body templates
+SIGN_IN_TEMPLATE = '<tsRequest><credentials name={0} password={1}><site contentUrl={2}/></credentials></tsRequest>'
+PUBLISH_TEMPLATE = '<tsRequest><datasource name={0}><project id={1}/></datasource></tsRequest>'
+
+# Qualified tag names, for matching elements while a response is parsed incrementally
+PROJECT_TAG = '{{{0}}}project'.format(xmlns['t'])
+PAGINATION_TAG = '{{{0}}}pagination'.format(xmlns['t'])
+
+# Header format: Content-Disposition: name="tableau_datasource"; filename="datasource-filename"
+FILENAME_PATTERN = re.compile(r'filename="([^"]*)"')
+
 # The maximum size of a file that can be published in a single request is 64MB
 FILESIZE_LIMIT = 1024 * 1024 * 64   # 64MB
 
 # For when a data source is over 64MB, break it into 5MB (standard chunk size) chunks
 CHUNK_SIZE = 1024 * 1024 * 5    # 5MB
 
+# Size of the blocks a file is read in while it is streamed into a request
+STREAM_BLOCK_SIZE = 1024 * 64   # 64KB
+
+# Stands in for the file data while the multipart framing around it is built
+FILE_PLACEHOLDER = b'--tableau-file-data--'
+
 # If using python version 3.x, 'raw_input()' is changed to 'input()'
 if sys.version[0] == '3': raw_input=input
 
@@ -63,7 +89,8 @@ class UserDefinedFieldError(Exception):
 def _encode_for_display(text):
     """
     Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
+    Responses are parsed from their raw bytes, so this is only needed for text
+    that is shown to the user.
 
     Returns an ASCII-encoded version of the text.
     Unicode characters are converted to ASCII placeholders (for example, "?").
@@ -93,6 +120,74 @@ def _make_multipart(parts):
     return post_body, content_type
 
 
+def _make_frame(parts):
+    """
+    Creates the multipart framing around data that is sent separately.
+
+    'parts' is a dictionary in the same format as for _make_multipart, where the
+    body of the part whose data is sent separately is FILE_PLACEHOLDER.
+
+    Returns the bytes that go before the data, the bytes that go after it,
+    and the content type string.
+    """
+    post_body, content_type = _make_multipart(parts)
+    prelude, trailer = post_body.split(FILE_PLACEHOLDER)
+    return prelude, trailer, content_type
+
+
+class _ChunkBody(object):
+    """
+    Request body for one chunk of a chunked upload.
+
+    The framing and the chunk data are handed to requests as separate pieces,
+    so the chunk is written to the socket without first being copied into a
+    single multipart body. Defining the length lets requests send a
+    Content-Length header instead of using chunked transfer encoding.
+    """
+    def __init__(self, prelude, data, trailer):
+        self.parts = [part for part in (prelude, data, trailer) if part]
+
+    def read(self, size=-1):
+        # http.client (httplib on Python 2.7) calls read() until it returns
+        # nothing. Each piece is returned whole, whatever size is asked for, so
+        # it reaches the socket in one call.
+        return self.parts.pop(0) if self.parts else b''
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+
+class _FileBody(object):
+    """
+    Request body that streams a file from disk between its multipart framing.
+
+    The file is read in STREAM_BLOCK_SIZE blocks as it is sent, so it is never
+    held in memory as a whole.
+    """
+    def __init__(self, prelude, filename, trailer):
+        self.prelude = prelude
+        self.filename = filename
+        self.trailer = trailer
+        self.blocks = None
+
+    def _iter_blocks(self):
+        yield self.prelude
+        with open(self.filename, 'rb') as f:
+            for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b''):
+                yield block
+        yield self.trailer
+
+    def read(self, size=-1):
+        # http.client (httplib on Python 2.7) calls read() until it returns
+        # nothing. Each call returns a whole block rather than the 8KB asked for.
+        if self.blocks is None:
+            self.blocks = self._iter_blocks()
+        return next(self.blocks, b'')
+
+    def __len__(self):
+        return len(self.prelude) + os.path.getsize(self.filename) + len(self.trailer)
+
+
 def _check_status(server_response, success_code):
     """
     Checks the server response for possible errors.
@@ -102,7 +197,7 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        parsed_response = ET.fromstring(server_response.content)
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -114,14 +209,30 @@ def _check_status(server_response, success_code):
         summary = summary_element.text if summary_element is not None else 'unknown summary'
         detail = detail_element.text if detail_element is not None else 'unknown detail'
         error_message = '{0}: {1} - {2}'.format(code, summary, detail)
-        raise ApiCallError(error_message)
+        raise ApiCallError(_encode_for_display(error_message))
     return
 
 
-def sign_in(server, username, password, site=""):
+def _make_session():
+    """
+    Creates a session that reuses its connections to a server.
+    Chunk uploads are not retried, as a resent chunk would be appended twice.
+    Returns the new session.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
 
+    'session'  session used to make requests to the server
     'server'   specified server address
     'username' is the name (not ID) of the user to sign in as.
                Note that most of the functions in this example require that the user
@@ -129,76 +240,73 @@ def sign_in(server, username, password, site=""):
     'password' is the password for the user.
     'site'     is the ID (as a string) of the site on the server to sign in to. The
                default is "", which signs in to the default site.
-    Returns the authentication token and the site ID.
+    The authentication token is sent with every later request made through the session.
+    Returns the site ID and the user ID.
     """
     url = server + "/api/{0}/auth/signin".format(VERSION)
 
     # Builds the request
-    xml_request = ET.Element('tsRequest')
-    credentials_element = ET.SubElement(xml_request, 'credentials', name=username, password=password)
-    ET.SubElement(credentials_element, 'site', contentUrl=site)
-    xml_request = ET.tostring(xml_request)
+    xml_request = SIGN_IN_TEMPLATE.format(quoteattr(username), quoteattr(password), quoteattr(site)).encode('utf-8')
 
     # Make the request to server
-    server_response = requests.post(url, data=xml_request)
+    server_response = session.post(url, data=xml_request)
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Gets the auth token and site ID
-    token = parsed_response.find('t:credentials', namespaces=xmlns).get('token')
-    site_id = parsed_response.find('.//t:site', namespaces=xmlns).get('id')
-    user_id = parsed_response.find('.//t:user', namespaces=xmlns).get('id')
-    return token, site_id, user_id
+    credentials_element = parsed_response.find('t:credentials', namespaces=xmlns)
+    token = credentials_element.get('token')
+    site_id = credentials_element.find('t:site', namespaces=xmlns).get('id')
+    user_id = credentials_element.find('t:user', namespaces=xmlns).get('id')
+    session.headers['x-tableau-auth'] = token
+    return site_id, user_id
 
 
-def sign_out(server, auth_token):
+def sign_out(session, server):
     """
     Destroys the active session and invalidates authentication token.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 204)
+    del session.headers['x-tableau-auth']
     return
 
-def start_upload_session(server, auth_token, site_id):
+def start_upload_session(session, server, site_id):
     """
     Creates a POST request that initiates a file upload session.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     Returns a session ID that is used by subsequent functions to identify the upload session.
     """
-    print(auth_token)
     url = server + "/api/{0}/sites/{1}/fileUploads".format(VERSION, site_id)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 201)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = ET.fromstring(server_response.content)
     return xml_response.find('t:fileUpload', namespaces=xmlns).get('uploadSessionId')
 
-def get_datasource_id(server, auth_token, site_id, datasource_name):
+def get_datasource_id(session, server, site_id, datasource_name):
     """
     Gets the id of the desired data source to relocate.
 
+    'session'           session used to make requests to the server
     'server'            specified server address
-    'auth_token'        authentication token that grants user access to API calls
     'user_id'           ID of user with access to data source
     'site_id'           ID of the site that the user is signed into
     'datasource_name'   name of data source to get ID of
     Returns the data source id and the project id that contains the data source.
     """
     url = server + "/api/{0}/sites/{1}/datasources".format(VERSION, site_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.get(url)
     _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = ET.fromstring(server_response.content)
 
     datasources = xml_response.findall('.//t:datasource', namespaces=xmlns)
     for datasource in datasources:
@@ -207,104 +315,106 @@ def get_datasource_id(server, auth_token, site_id, datasource_name):
     error = "Data source named '{0}' not found.".format(datasource_name)
     raise LookupError(error)
 
-def get_default_project_id(server, auth_token, site_id):
+def get_default_project_id(session, server, site_id):
     """
     Returns the project ID for the 'default' project on the Tableau server.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     """
-    page_num, page_size = 1, 100  # Default paginating values
+    page_num, page_size = 1, 1000   # Largest page size the REST API allows, to keep round trips down
 
-    # Builds the request
     url = server + "/api/{0}/sites/{1}/projects".format(VERSION, site_id)
-    paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-    server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-
-    # Used to determine if more requests are required to find all projects on server
-    total_projects = int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
-    max_page = int(math.ceil(total_projects / page_size))
-
-    projects = xml_response.findall('.//t:project', namespaces=xmlns)
-
-    # Continue querying if more projects exist on the server
-    for page in range(2, max_page + 1):
-        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page)
-        server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
-        _check_status(server_response, 200)
-        xml_response = ET.fromstring(_encode_for_display(server_response.text))
-        projects.extend(xml_response.findall('.//t:project', namespaces=xmlns))
-
-    # Look through all projects to find the 'default' one (EN and DE locales)
-    for project in projects:
-        if project.get('name') == 'default' or project.get('name') == 'Default' or project.get('name') == 'standard' or project.get('name') == 'Standard':
-            return project.get('id')
+    while True:
+        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+        # Parse the page as it arrives, clearing each project once it has been
+        # checked, and stop at the 'default' project (EN and DE locales) without reading any further
+        with session.get(paged_url, stream=True) as server_response:
+            _check_status(server_response, 200)
+            server_response.raw.decode_content = True
+            total_projects = 0
+            for _, element in ET.iterparse(server_response.raw):
+                if element.tag == PAGINATION_TAG:
+                    total_projects = int(element.get('totalAvailable'))
+                elif element.tag == PROJECT_TAG:
+                    if element.get('name') == 'default' or element.get('name') == 'Default' or element.get('name') == 'standard' or element.get('name') == 'Standard':
+                        return element.get('id')
+                    element.clear()
+
+        # Stop once every project on the server has been looked at
+        if page_num * page_size >= total_projects:
+            break
+        page_num += 1
     print("\tProject named 'default' was not found in {0}".format(server))
 
-def download(server, auth_token, site_id, datasource_id):
+def download(session, server, site_id, datasource_id):
     """
     Downloads the desired data source from the server (temp-file).
 
+    'session'         session used to make requests to the server
     'server'          specified server address
-    'auth_token'      authentication token that grants user access to API calls
     'site_id'         ID of the site that the user is signed into
     'datasource_id'   ID of the data soutce to download
     Returns the filename of the data source downloaded.
     """
     print("\tDownloading data source to a temp file")
     url = server + "/api/{0}/sites/{1}/datasources/{2}/content".format(VERSION, site_id, datasource_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
+    # Stream the body so it is written to disk as it arrives instead of
+    # being held in memory as a whole first
+    with session.get(url, stream=True) as server_response:
+        _check_status(server_response, 200)
 
-    # Header format: Content-Disposition: name="tableau_datasource"; filename="datasource-filename"
-    filename = re.findall(r'filename="(.*)"', server_response.headers['Content-Disposition'])[0]
-    with open(filename, 'wb') as f:
-        f.write(server_response.content)
+        filename = FILENAME_PATTERN.search(server_response.headers['Content-Disposition']).group(1)
+        with open(filename, 'wb') as f:
+            for data in server_response.iter_content(CHUNK_SIZE):
+                f.write(data)
     return filename
 
-def publish_datasource(server, auth_token, site_id, datasource_filename, dest_project_id):
+def publish_datasource(session, server, site_id, datasource_filename, dest_project_id):
     """
     Publishes the data source to the desired project.
 
+    'session'              session used to make requests to the server
     'server'               specified server address
-    'auth_token'           authentication token that grants user access to API calls
     'site_id'              ID of the site that the user is signed into
     'datasource_filename'  filename of data source to publish
     'dest_project_id'      ID of peoject to publish to
     """
-    datasource_name, file_extension = datasource_filename.split('.', 1)
+    # Split on the last dot only, so names such as 'Sales.v2.tdsx' keep their full name
+    datasource_name, file_extension = os.path.splitext(os.path.basename(datasource_filename))
+    file_extension = quote(file_extension.lstrip('.'), safe='')
     datasource_size = os.path.getsize(datasource_filename)
     chunked = datasource_size >= FILESIZE_LIMIT
 
     # Build a general request for publishing
-    xml_request = ET.Element('tsRequest')
-    datasource_element = ET.SubElement(xml_request, 'datasource', name=datasource_name)
-    ET.SubElement(datasource_element, 'project', id=dest_project_id)
-    xml_request = ET.tostring(xml_request)
+    xml_request = PUBLISH_TEMPLATE.format(quoteattr(datasource_name), quoteattr(dest_project_id)).encode('utf-8')
 
     if chunked:
         print("\tPublishing '{0}' in {1}MB chunks (data source over 64MB):".format(datasource_name, CHUNK_SIZE / 1024000))
         # Initiates an upload session
-        print(auth_token)
-        upload_id = start_upload_session(server, auth_token, site_id)
+        upload_id = start_upload_session(session, server, site_id)
 
         # URL for PUT request to append chunks for publishing
         put_url = server + "/api/{0}/sites/{1}/fileUploads/{2}".format(VERSION, site_id, upload_id)
 
+        # The multipart framing is the same for every chunk, so it is built once
+        prelude, trailer, content_type = _make_frame({'request_payload': ('', '', 'text/xml'),
+                                                      'tableau_file': ('file', FILE_PLACEHOLDER, 'application/octet-stream')})
+
         # Reads and uploads chunks of the data source
         with open(datasource_filename, 'rb') as f:
+            # The file is read front to back, so let the kernel read ahead further
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
             while True:
                 data = f.read(CHUNK_SIZE)
                 if not data:
                     break
-                payload, content_type = _make_multipart({'request_payload': ('', '', 'text/xml'),
-                                                         'tableau_file': ('file', data, 'application/octet-stream')})
                 print("\tPublishing a chunk...")
-                server_response = requests.put(put_url, data=payload,
-                                               headers={'x-tableau-auth': auth_token, "content-type": content_type})
+                server_response = session.put(put_url, data=_ChunkBody(prelude, data, trailer),
+                                              headers={"content-type": content_type})
                 _check_status(server_response, 200)
 
         # Finish building request for chunking method
@@ -316,37 +426,36 @@ def publish_datasource(server, auth_token, site_id, datasource_filename, dest_pr
     else:
         print("\tPublishing '{0}' using the all-in-one method (data source under 64MB)".format(datasource_name))
 
-        # Read the contents of the file to publish
-        with open(datasource_filename, 'rb') as f:
-            datasource_bytes = f.read()
-
-        # Finish building request for all-in-one method
+        # Finish building request for all-in-one method. The data source is streamed
+        # from disk between the multipart framing as the request is sent, rather
+        # than read into memory first.
         parts = {'request_payload': ('', xml_request, 'text/xml'),
-                 'tableau_datasource': (datasource_filename, datasource_bytes, 'application/octet-stream')}
-        payload, content_type = _make_multipart(parts)
+                 'tableau_datasource': (datasource_filename, FILE_PLACEHOLDER, 'application/octet-stream')}
+        prelude, trailer, content_type = _make_frame(parts)
+        payload = _FileBody(prelude, datasource_filename, trailer)
 
         publish_url = server + "/api/{0}/sites/{1}/datasources".format(VERSION, site_id)
         publish_url += "?datasourceType={0}&overwrite=true".format(file_extension)
 
     # Make the request to publish and check status code
     print("\tUploading...")
-    server_response = requests.post(publish_url, data=payload,
-                                    headers={'x-tableau-auth': auth_token, 'content-type': content_type})
+    server_response = session.post(publish_url, data=payload,
+                                   headers={'content-type': content_type})
     _check_status(server_response, 201)
 
-def delete_datasource(server, auth_token, site_id, datasource_id, datasource_filename):
+def delete_datasource(session, server, site_id, datasource_id, datasource_filename):
     """
     Deletes the temp data source file, and data source from the source project.
 
+    'session'              session used to make requests to the server
     'server'               specified server address
-    'auth_token'           authentication token that grants user access to API calls
     'site_id'              ID of the site that the user is signed into
     'datasource_id'        ID of data source to delete
     'datasource_filename'  filename of temp data source file to delete
     """
     # Builds the request to delete data source from the source project on server
     url = server + "/api/{0}/sites/{1}/datasources/{2}".format(VERSION, site_id, datasource_id)
-    server_response = requests.delete(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.delete(url)
     _check_status(server_response, 204)
 
     # Remove the temp file created for the download
@@ -372,37 +481,40 @@ def main():
 
     ##### STEP 1: Sign in #####
     print("\n1. Signing in to both sites to obtain authentication tokens")
+    # Each server gets its own session, so its connections are reused by every later call
+    source_session = _make_session()
+    dest_session = _make_session()
+
     # Source server (site "RESTTest")
-    source_auth_token, source_site_id, source_user_id = sign_in(source_server, source_username, source_password, source_site)
+    source_site_id, source_user_id = sign_in(source_session, source_server, source_username, source_password, source_site)
 
     # Destination server (site "KonstantinsLiebewiese")
-    dest_auth_token, dest_site_id, dest_user_id = sign_in(dest_server, dest_username, dest_password, dest_site)
+    dest_site_id, dest_user_id = sign_in(dest_session, dest_server, dest_username, dest_password, dest_site)
 
     ##### STEP 2: Find data source id #####
     print("\n2. Finding data source id of '{0}'".format(datasource_name))
-    datasource_id = get_datasource_id(source_server, source_auth_token, source_site_id, datasource_name)
+    datasource_id = get_datasource_id(source_session, source_server, source_site_id, datasource_name)
     
     ##### STEP 3: Find 'default' project id for destination server #####
     print("\n3. Finding 'default' project id for {0}".format(dest_server))
-    dest_project_id = get_default_project_id(dest_server, dest_auth_token, dest_site_id)
+    dest_project_id = get_default_project_id(dest_session, dest_server, dest_site_id)
 
     ##### STEP 4: Download data source #####
     print("\n4. Downloading the data source to move")
-    datasource_filename = download(source_server, source_auth_token, source_site_id, datasource_id)
+    datasource_filename = download(source_session, source_server, source_site_id, datasource_id)
 
     ##### STEP 5: Publish to new site #####
     print("\n5. Publishing data source to {0}".format(dest_server))
-    print(dest_auth_token)
-    publish_datasource(dest_server, dest_auth_token, dest_site_id, datasource_filename, dest_project_id)
+    publish_datasource(dest_session, dest_server, dest_site_id, datasource_filename, dest_project_id)
 
     ##### STEP 6: Deleting data source from the source site #####
     print("\n6. Deleting data source from the original site and temp file")
-    delete_datasource(source_server, source_auth_token, source_site_id, datasource_id, datasource_filename)
+    delete_datasource(source_session, source_server, source_site_id, datasource_id, datasource_filename)
 
     ##### STEP 7: Sign out #####
     print("\n7. Signing out and invalidating the authentication token")
-    sign_out(source_server, source_auth_token)
-    sign_out(dest_server, dest_auth_token)
+    sign_out(source_session, source_server)
+    sign_out(dest_session, dest_server)
 
 
 if __name__ == "__main__":
@@ -19,15 +19,28 @@
 
 from version import VERSION
 import requests # Contains methods used to make HTTP requests
-import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+try:
+    from lxml import etree as ET # Contains methods used to build and parse XML (libxml2-backed)
+except ImportError:
+    import xml.etree.ElementTree as ET # Falls back to the standard library parser
 import sys
-import math
 import getpass
+from xml.sax.saxutils import quoteattr # Escapes values placed in XML attributes
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 # The namespace for the REST API is 'http://tableausoftware.com/api' for Tableau Server 9.0
 # or 'http://tableau.com/api' for Tableau Server 9.1 or later
 xmlns = {'t': 'http://tableau.com/api'}
 
+# Request body templates
+SIGN_IN_TEMPLATE = '<tsRequest><credentials name={0} password={1}><site contentUrl={2}/></credentials></tsRequest>'
+
+# Qualified tag names, for matching elements while a response is parsed incrementally
+WORKBOOK_TAG = '{{{0}}}workbook'.format(xmlns['t'])
+PROJECT_TAG = '{{{0}}}project'.format(xmlns['t'])
+PAGINATION_TAG = '{{{0}}}pagination'.format(xmlns['t'])
+
 # If using python version 3.x, 'raw_input()' is changed to 'input()'
 if sys.version[0] == '3': raw_input=input
 
@@ -43,7 +56,8 @@ class UserDefinedFieldError(Exception):
 def _encode_for_display(text):
     """
     Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
+    Responses are parsed from their raw bytes, so this is only needed for text
+    that is shown to the user.
 
     Returns an ASCII-encoded version of the text.
     Unicode characters are converted to ASCII placeholders (for example, "?").
@@ -60,7 +74,7 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        parsed_response = ET.fromstring(server_response.content)
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -72,14 +86,29 @@ def _check_status(server_response, success_code):
         summary = summary_element.text if summary_element is not None else 'unknown summary'
         detail = detail_element.text if detail_element is not None else 'unknown detail'
         error_message = '{0}: {1} - {2}'.format(code, summary, detail)
-        raise ApiCallError(error_message)
+        raise ApiCallError(_encode_for_display(error_message))
     return
 
 
-def sign_in(server, username, password, site=""):
+def _make_session():
+    """
+    Creates a session that reuses its connection to the server.
+    Returns the new session.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'], raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
 
+    'session'  session used to make requests to the server
     'server'   specified server address
     'name'     is the name (not ID) of the user to sign in as.
                Note that most of the functions in this example require that the user
@@ -87,117 +116,127 @@ def sign_in(server, username, password, site=""):
     'password' is the password for the user.
     'site'     is the ID (as a string) of the site on the server to sign in to. The
                default is "", which signs in to the default site.
-    Returns the authentication token and the site ID.
+    The authentication token is sent with every later request made through the session.
+    Returns the site ID and the user ID.
     """
     url = server + "/api/{0}/auth/signin".format(VERSION)
 
     # Builds the request
-    xml_request = ET.Element('tsRequest')
-    credentials_element = ET.SubElement(xml_request, 'credentials', name=username, password=password)
-    ET.SubElement(credentials_element, 'site', contentUrl=site)
-    xml_request = ET.tostring(xml_request)
+    xml_request = SIGN_IN_TEMPLATE.format(quoteattr(username), quoteattr(password), quoteattr(site)).encode('utf-8')
 
     # Make the request to server
-    server_response = requests.post(url, data=xml_request)
+    server_response = session.post(url, data=xml_request)
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Gets the auth token and site ID
-    token = parsed_response.find('t:credentials', namespaces=xmlns).get('token')
-    site_id = parsed_response.find('.//t:site', namespaces=xmlns).get('id')
-    user_id = parsed_response.find('.//t:user', namespaces=xmlns).get('id')
-    return token, site_id, user_id
+    credentials_element = parsed_response.find('t:credentials', namespaces=xmlns)
+    token = credentials_element.get('token')
+    site_id = credentials_element.find('t:site', namespaces=xmlns).get('id')
+    user_id = credentials_element.find('t:user', namespaces=xmlns).get('id')
+    session.headers['x-tableau-auth'] = token
+    return site_id, user_id
 
 
-def sign_out(server, auth_token):
+def sign_out(session, server):
     """
     Destroys the active session and invalidates authentication token.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 204)
+    del session.headers['x-tableau-auth']
     return
 
 
-def get_workbook_id(server, auth_token, user_id, site_id, workbook_name):
+def get_workbook_id(session, server, user_id, site_id, workbook_name):
     """
     Gets the id of the desired workbook to relocate.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'user_id'       ID of user with access to workbook
     'site_id'       ID of the site that the user is signed into
     'workbook_name' name of workbook to get ID of
     Returns the workbook id and the project id that contains the workbook.
     """
-    url = server + "/api/{0}/sites/{1}/users/{2}/workbooks".format(VERSION, site_id, user_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    page_num, page_size = 1, 1000   # Largest page size the REST API allows, to keep round trips down
 
-    workbooks = xml_response.findall('.//t:workbook', namespaces=xmlns)
-    for workbook in workbooks:
-        if workbook.get('name') == workbook_name:
-            source_project_id = workbook.find('.//t:project', namespaces=xmlns).get('id')
-            return source_project_id, workbook.get('id')
+    url = server + "/api/{0}/sites/{1}/users/{2}/workbooks".format(VERSION, site_id, user_id)
+    while True:
+        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+        # Parse the page as it arrives, clearing each workbook once it has been
+        # checked, and stop at the workbook without reading any further
+        with session.get(paged_url, stream=True) as server_response:
+            _check_status(server_response, 200)
+            server_response.raw.decode_content = True
+            total_workbooks = 0
+            for _, element in ET.iterparse(server_response.raw):
+                if element.tag == PAGINATION_TAG:
+                    total_workbooks = int(element.get('totalAvailable'))
+                elif element.tag == WORKBOOK_TAG:
+                    if element.get('name') == workbook_name:
+                        source_project_id = element.find('.//t:project', namespaces=xmlns).get('id')
+                        return source_project_id, element.get('id')
+                    element.clear()
+
+        # Stop once every workbook the user can see has been looked at
+        if page_num * page_size >= total_workbooks:
+            break
+        page_num += 1
     error = "Workbook named '{0}' not found.".format(workbook_name)
     raise LookupError(error)
 
 
-def get_project_id(server, auth_token, site_id, dest_project):
+def get_project_id(session, server, site_id, dest_project):
     """
     Returns the project ID of the desired project
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     'dest_project'  name of destination project to get ID of
     """
-    page_num, page_size = 1, 100   # Default paginating values
+    page_num, page_size = 1, 1000   # Largest page size the REST API allows, to keep round trips down
 
-    # Builds the request
     url = server + "/api/{0}/sites/{1}/projects".format(VERSION, site_id)
-    paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-    server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-
-    # Used to determine if more requests are required to find all projects on server
-    total_projects = int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
-    max_page = int(math.ceil(total_projects / page_size))
-
-    projects = xml_response.findall('.//t:project', namespaces=xmlns)
-
-    # Continue querying if more projects exist on the server
-    for page in range(2, max_page + 1):
-        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page)
-        server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
-        _check_status(server_response, 200)
-        xml_response = ET.fromstring(_encode_for_display(server_response.text))
-        projects.extend(xml_response.findall('.//t:project', namespaces=xmlns))
-
-    # Look through all projects to find the 'default' one
-    for project in projects:
-        if project.get('name') == dest_project:
-            return project.get('id')
+    while True:
+        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+        # Parse the page as it arrives, clearing each project once it has been
+        # checked, and stop at the project without reading any further
+        with session.get(paged_url, stream=True) as server_response:
+            _check_status(server_response, 200)
+            server_response.raw.decode_content = True
+            total_projects = 0
+            for _, element in ET.iterparse(server_response.raw):
+                if element.tag == PAGINATION_TAG:
+                    total_projects = int(element.get('totalAvailable'))
+                elif element.tag == PROJECT_TAG:
+                    if element.get('name') == dest_project:
+                        return element.get('id')
+                    element.clear()
+
+        # Stop once every project on the server has been looked at
+        if page_num * page_size >= total_projects:
+            break
+        page_num += 1
     error = "Project named '{0}' was not found on server".format(dest_project)
     raise LookupError(error)
 
 
-def move_workbook(server, auth_token, site_id, workbook_id, project_id):
+def move_workbook(session, server, site_id, workbook_id, project_id):
     """
     Moves the specified workbook to another project.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     'workbook_id'   ID of the workbook to move
     'project_id'    ID of the project to move workbook into
@@ -209,7 +248,7 @@ def move_workbook(server, auth_token, site_id, workbook_id, project_id):
     ET.SubElement(workbook_element, 'project', id=project_id)
     xml_request = ET.tostring(xml_request)
 
-    server_response = requests.put(url, data=xml_request, headers={'x-tableau-auth': auth_token})
+    server_response = session.put(url, data=xml_request)
     _check_status(server_response, 200)
 
 
@@ -228,15 +267,16 @@ def main():
 
     ##### STEP 1: Sign in #####
     print("\n1. Signing in as " + username)
-    auth_token, site_id, user_id = sign_in(server, username, password)
+    session = _make_session()
+    site_id, user_id = sign_in(session, server, username, password)
 
     ##### STEP 2: Find new project id #####
     print("\n2. Finding project id of '{0}'".format(dest_project))
-    dest_project_id = get_project_id(server, auth_token, site_id, dest_project)
+    dest_project_id = get_project_id(session, server, site_id, dest_project)
 
     ##### STEP 3: Find workbook id #####
     print("\n3. Finding workbook id of '{0}'".format(workbook_name))
-    source_project_id, workbook_id = get_workbook_id(server, auth_token, user_id, site_id, workbook_name)
+    source_project_id, workbook_id = get_workbook_id(session, server, user_id, site_id, workbook_name)
 
     # Check if the workbook is already in the desired project
     if source_project_id == dest_project_id:
@@ -245,11 +285,11 @@ def main():
 
     ##### STEP 4: Move workbook #####
     print("\n4. Moving workbook to '{0}'".format(dest_project))
-    move_workbook(server, auth_token, site_id, workbook_id, dest_project_id)
+    move_workbook(session, server, site_id, workbook_id, dest_project_id)
 
     ##### STEP 5: Sign out #####
     print("\n5. Signing out and invalidating the authentication token")
-    sign_out(server, auth_token)
+    sign_out(session, server)
 
 
 if __name__ == "__main__":
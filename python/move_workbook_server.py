@@ -21,12 +21,28 @@
 
 from version import VERSION
 import requests # Contains methods used to make HTTP requests
-import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+try:
+    from lxml import etree as ET # Contains methods used to build and parse XML (libxml2-backed)
+except ImportError:
+    import xml.etree.ElementTree as ET # Falls back to the standard library parser
 import sys
 import re
-import math
 import getpass
 import os
+import threading
+from xml.sax.saxutils import quoteattr # Escapes values placed in XML attributes
+
+try:
+    import queue
+    from urllib.parse import quote
+except ImportError:
+    import Queue as queue  # Python 2.7
+    from urllib import quote
+
+# Used to keep connections to each server alive across requests, and to retry
+# requests that fail because of a dropped connection or a busy server
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 # The following packages are used to build a multi-part/mixed request.
 # They are contained in the 'requests' library
@@ -35,19 +51,44 @@ from requests.packages.urllib3.filepost import encode_multipart_formdata
 
 #####
 # Move a specified workbook from a source server to a specified
-# server's 'default' project by downloading workbook to a temp file.
+# server's 'default' project. The workbook is never written to disk:
+# workbooks over 64MB are uploaded in chunks while they are still
+# downloading, and smaller ones are published from memory.
 #####
 
 # The namespace for the REST API is 'http://tableausoftware.com/api' for Tableau Server 9.0
 # or 'http://tableau.com/api' for Tableau Server 9.1 or later
 xmlns = {'t': 'http://tableau.com/api'}
 
+# Namespace-qualified tag names, so lookups do not resolve the 't:' prefix on every call
+CREDENTIALS_TAG = '{{{0}}}credentials'.format(xmlns['t'])
+SITE_TAG = '{{{0}}}site'.format(xmlns['t'])
+USER_TAG = '{{{0}}}user'.format(xmlns['t'])
+FILE_UPLOAD_TAG = '{{{0}}}fileUpload'.format(xmlns['t'])
+WORKBOOK_TAG = '{{{0}}}workbook'.format(xmlns['t'])
+PROJECT_TAG = '{{{0}}}project'.format(xmlns['t'])
+PAGINATION_TAG = '{{{0}}}pagination'.format(xmlns['t'])
+
+# Header format: Content-Disposition: name="tableau_workbook"; filename="workbook-filename"
+FILENAME_PATTERN = re.compile(r'filename="([^"]*)"')
+
 # The maximum size of a file that can be published in a single request is 64MB
 FILESIZE_LIMIT = 1024 * 1024 * 64   # 64MB
 
 # For when a workbook is over 64MB, break it into 5MB(standard chunk size) chunks
 CHUNK_SIZE = 1024 * 1024 * 5    # 5MB
 
+# Number of chunks read ahead while the current chunk is being uploaded
+READ_AHEAD_CHUNKS = 2
+
+# Request bodies have a fixed shape, so they are filled in from templates
+# rather than built and serialized as element trees
+SIGN_IN_TEMPLATE = '<tsRequest><credentials name={0} password={1}><site contentUrl={2}/></credentials></tsRequest>'
+PUBLISH_TEMPLATE = '<tsRequest><workbook name={0}><project id={1}/></workbook></tsRequest>'
+
+# Stands in for the file data while the multipart framing around it is built
+FILE_PLACEHOLDER = b'--tableau-file-data--'
+
 # If using python version 3.x, 'raw_input()' is changed to 'input()'
 if sys.version[0] == '3': raw_input=input
 
@@ -63,7 +104,8 @@ class UserDefinedFieldError(Exception):
 def _encode_for_display(text):
     """
     Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
+    Responses are parsed from their raw bytes, so this is only needed for text
+    that is shown to the user.
 
     Returns an ASCII-encoded version of the text.
     Unicode characters are converted to ASCII placeholders (for example, "?").
@@ -93,6 +135,125 @@ def _make_multipart(parts):
     return post_body, content_type
 
 
+def _make_frame(parts):
+    """
+    Creates the multipart framing around data that is sent separately.
+
+    'parts' is a dictionary in the same format as for _make_multipart, where the
+    body of the part whose data is sent separately is FILE_PLACEHOLDER.
+
+    Returns the bytes that go before the data, the bytes that go after it,
+    and the content type string.
+    """
+    post_body, content_type = _make_multipart(parts)
+    prelude, trailer = post_body.split(FILE_PLACEHOLDER)
+    return prelude, trailer, content_type
+
+
+class _ChunkBody(object):
+    """
+    Request body for a chunk of a chunked upload, or a whole small workbook.
+
+    The framing and the chunk data are handed to requests as separate pieces,
+    so the chunk is written to the socket without first being copied into a
+    single multipart body. Defining the length lets requests send a
+    Content-Length header instead of using chunked transfer encoding.
+    """
+    def __init__(self, prelude, data, trailer):
+        self.parts = [part for part in (prelude, data, trailer) if part]
+
+    def read(self, size=-1):
+        # http.client (httplib on Python 2.7) calls read() until it returns
+        # nothing. Each piece is returned whole, whatever size is asked for, so
+        # it reaches the socket in one call.
+        return self.parts.pop(0) if self.parts else b''
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+
+def _read_ahead(chunks):
+    """
+    Iterates over 'chunks' while the following chunks are read on another thread.
+
+    Tableau appends the chunks of an upload session in the order they arrive,
+    so they cannot be uploaded in parallel. Reading the next chunk while the
+    current one is being uploaded still keeps the network busy instead of
+    waiting on the read between every request. At most READ_AHEAD_CHUNKS
+    chunks are held in memory at a time.
+
+    If the upload stops early, the reader is stopped and waited for before
+    the caller goes on to close the source the chunks are read from.
+
+    'chunks'    iterable of the byte chunks to upload
+    """
+    buffered = queue.Queue(maxsize=READ_AHEAD_CHUNKS)
+    stopped = threading.Event()
+
+    def fill():
+        try:
+            for chunk in chunks:
+                buffered.put(chunk)
+                # Exit before the next read if the upload has stopped
+                if stopped.is_set():
+                    return
+        except Exception as error:
+            # Hand the error to the uploading thread instead of losing it here
+            buffered.put(error)
+        buffered.put(None)
+
+    reader = threading.Thread(target=fill)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            chunk = buffered.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # Keep taking chunks off the queue until the reader exits, so it is
+        # never left waiting to add a chunk that will not be uploaded
+        stopped.set()
+        while reader.is_alive():
+            try:
+                buffered.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _start_in_background(func, *args):
+    """
+    Runs a function on a background thread so other requests can be made meanwhile.
+
+    'func'      function to run
+    'args'      arguments to call the function with
+    Returns a function that waits for the background call to finish and
+    returns its result, or raises the error it failed with.
+    """
+    results = []
+    errors = []
+
+    def run():
+        try:
+            results.append(func(*args))
+        except Exception as error:
+            # Hand the error to the waiting thread instead of losing it here
+            errors.append(error)
+
+    worker = threading.Thread(target=run)
+    worker.start()
+
+    def wait():
+        worker.join()
+        if errors:
+            raise errors[0]
+        return results[0]
+    return wait
+
+
 def _check_status(server_response, success_code):
     """
     Checks the server response for possible errors.
@@ -102,7 +263,7 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        parsed_response = ET.fromstring(server_response.content)
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -114,14 +275,35 @@ def _check_status(server_response, success_code):
         summary = summary_element.text if summary_element is not None else 'unknown summary'
         detail = detail_element.text if detail_element is not None else 'unknown detail'
         error_message = '{0}: {1} - {2}'.format(code, summary, detail)
-        raise ApiCallError(error_message)
+        raise ApiCallError(_encode_for_display(error_message))
     return
 
 
-def sign_in(server, username, password, site=""):
+def _make_session():
+    """
+    Creates a session that reuses its connections to a server.
+
+    Every request made through the same session shares a pool of keep-alive
+    connections, so only the first call to a server pays for the TCP and TLS
+    handshakes. Failed connections are retried with backoff, as are GET
+    requests that hit a busy or failing server. Other requests are not retried
+    on a server error, since resending a chunk would append it twice.
+    Returns the new session.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
 
+    'session'  session used to make requests to the server
     'server'   specified server address
     'username' is the name (not ID) of the user to sign in as.
                Note that most of the functions in this example require that the user
@@ -129,186 +311,235 @@ def sign_in(server, username, password, site=""):
     'password' is the password for the user.
     'site'     is the ID (as a string) of the site on the server to sign in to. The
                default is "", which signs in to the default site.
-    Returns the authentication token and the site ID.
+    The authentication token is sent with every later request made through the session.
+    Returns the site ID and the user ID.
     """
     url = server + "/api/{0}/auth/signin".format(VERSION)
 
     # Builds the request
-    xml_request = ET.Element('tsRequest')
-    credentials_element = ET.SubElement(xml_request, 'credentials', name=username, password=password)
-    ET.SubElement(credentials_element, 'site', contentUrl=site)
-    xml_request = ET.tostring(xml_request)
+    xml_request = SIGN_IN_TEMPLATE.format(quoteattr(username), quoteattr(password), quoteattr(site)).encode('utf-8')
 
     # Make the request to server
-    server_response = requests.post(url, data=xml_request)
+    server_response = session.post(url, data=xml_request)
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Gets the auth token and site ID
-    token = parsed_response.find('t:credentials', namespaces=xmlns).get('token')
-    site_id = parsed_response.find('.//t:site', namespaces=xmlns).get('id')
-    user_id = parsed_response.find('.//t:user', namespaces=xmlns).get('id')
-    return token, site_id, user_id
+    credentials_element = parsed_response.find(CREDENTIALS_TAG)
+    token = credentials_element.get('token')
+    site_id = credentials_element.find(SITE_TAG).get('id')
+    user_id = credentials_element.find(USER_TAG).get('id')
+    session.headers['x-tableau-auth'] = token
+    return site_id, user_id
 
 
-def sign_out(server, auth_token):
+def sign_out(session, server):
     """
     Destroys the active session and invalidates authentication token.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 204)
+    del session.headers['x-tableau-auth']
     return
 
 
-def start_upload_session(server, auth_token, site_id):
+def start_upload_session(session, server, site_id):
     """
     Creates a POST request that initiates a file upload session.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     Returns a session ID that is used by subsequent functions to identify the upload session.
     """
     url = server + "/api/{0}/sites/{1}/fileUploads".format(VERSION, site_id)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 201)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    return xml_response.find('t:fileUpload', namespaces=xmlns).get('uploadSessionId')
+    xml_response = ET.fromstring(server_response.content)
+    return xml_response.find(FILE_UPLOAD_TAG).get('uploadSessionId')
 
 
-def get_workbook_id(server, auth_token, user_id, site_id, workbook_name):
+def get_workbook_id(session, server, user_id, site_id, workbook_name):
     """
     Gets the id of the desired workbook to relocate.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'user_id'       ID of user with access to workbook
     'site_id'       ID of the site that the user is signed into
     'workbook_name' name of workbook to get ID of
     Returns the workbook id and the project id that contains the workbook.
     """
-    url = server + "/api/{0}/sites/{1}/users/{2}/workbooks".format(VERSION, site_id, user_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    page_num, page_size = 1, 1000   # Largest page size the REST API allows, to keep round trips down
 
-    workbooks = xml_response.findall('.//t:workbook', namespaces=xmlns)
-    for workbook in workbooks:
-        if workbook.get('name') == workbook_name:
-            return workbook.get('id')
+    url = server + "/api/{0}/sites/{1}/users/{2}/workbooks".format(VERSION, site_id, user_id)
+    while True:
+        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+        # Parse the page as it arrives, clearing each workbook once it has been
+        # checked, and stop at the workbook without reading any further
+        with session.get(paged_url, stream=True) as server_response:
+            _check_status(server_response, 200)
+            server_response.raw.decode_content = True
+            total_workbooks = 0
+            for _, element in ET.iterparse(server_response.raw):
+                if element.tag == PAGINATION_TAG:
+                    total_workbooks = int(element.get('totalAvailable'))
+                elif element.tag == WORKBOOK_TAG:
+                    if element.get('name') == workbook_name:
+                        return element.get('id')
+                    element.clear()
+
+        # Stop once every workbook the user can see has been looked at
+        if page_num * page_size >= total_workbooks:
+            break
+        page_num += 1
     error = "Workbook named '{0}' not found.".format(workbook_name)
     raise LookupError(error)
 
 
-def get_default_project_id(server, auth_token, site_id):
+def get_default_project_id(session, server, site_id):
     """
     Returns the project ID for the 'default' project on the Tableau server.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     """
-    page_num, page_size = 1, 100  # Default paginating values
-
-    # Builds the request
     url = server + "/api/{0}/sites/{1}/projects".format(VERSION, site_id)
-    paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-    server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-
-    # Used to determine if more requests are required to find all projects on server
-    total_projects = int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
-    max_page = int(math.ceil(total_projects / page_size))
-
-    projects = xml_response.findall('.//t:project', namespaces=xmlns)
 
-    # Continue querying if more projects exist on the server
-    for page in range(2, max_page + 1):
-        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page)
-        server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
+    # Let the server filter by name, so a single short page holds the answer
+    # ('Default' is the name used by German-locale servers)
+    server_response = session.get(url + "?filter=name:in:[default,Default]")
+    if server_response.status_code != 400:
         _check_status(server_response, 200)
-        xml_response = ET.fromstring(_encode_for_display(server_response.text))
-        projects.extend(xml_response.findall('.//t:project', namespaces=xmlns))
-
-    # Look through all projects to find the 'default' one
-    for project in projects:
-        if project.get('name') == 'default' or project.get('name') == 'Default':
-            return project.get('id')
-    print("\tProject named 'default' was not found in {0}".format(server))
+        xml_response = ET.fromstring(server_response.content)
+        for project in xml_response.iter(PROJECT_TAG):
+            if project.get('name') == 'default' or project.get('name') == 'Default':
+                return project.get('id')
+        error = "Project named 'default' was not found in {0}".format(server)
+        raise LookupError(error)
+
+    # Servers that cannot filter projects reject the request with a 400, so page
+    # through every project instead
+    page_num, page_size = 1, 1000  # Largest page size the REST API allows, to keep round trips down
+    while True:
+        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+        # Parse the page straight from the connection, checking each project as it
+        # arrives and stopping at the 'default' one without reading the rest of the
+        # page or requesting any later pages
+        with session.get(paged_url, stream=True) as server_response:
+            _check_status(server_response, 200)
+            server_response.raw.decode_content = True
+            total_projects = 0
+            for _, element in ET.iterparse(server_response.raw):
+                if element.tag == PAGINATION_TAG:
+                    total_projects = int(element.get('totalAvailable'))
+                elif element.tag == PROJECT_TAG:
+                    if element.get('name') == 'default' or element.get('name') == 'Default':
+                        return element.get('id')
+                    element.clear()
+
+        # Stop once every project on the server has been looked at
+        if page_num * page_size >= total_projects:
+            break
+        page_num += 1
+    error = "Project named 'default' was not found in {0}".format(server)
+    raise LookupError(error)
 
 
-def download(server, auth_token, site_id, workbook_id):
+def download(session, server, site_id, workbook_id):
     """
-    Downloads the desired workbook from the server (temp-file).
+    Starts downloading the desired workbook from the server.
 
+    Only the headers are read here. The body is left on the open response, so
+    it can be uploaded to the destination while it is still arriving.
+
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     'workbook_id'   ID of the workbook to download
-    Returns the filename of the workbook downloaded.
+    Returns the filename of the workbook and the streamed response.
     """
-    print("\tDownloading workbook to a temp file")
     url = server + "/api/{0}/sites/{1}/workbooks/{2}/content".format(VERSION, site_id, workbook_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
+
+    # Stream the body so only one chunk of the workbook is held in memory at a time
+    server_response = session.get(url, stream=True)
     _check_status(server_response, 200)
 
-    # Header format: Content-Disposition: name="tableau_workbook"; filename="workbook-filename"
-    filename = re.findall(r'filename="(.*)"', server_response.headers['Content-Disposition'])[0]
-    with open(filename, 'wb') as f:
-        f.write(server_response.content)
-    return filename
+    filename = FILENAME_PATTERN.search(server_response.headers['Content-Disposition']).group(1)
+    return filename, server_response
 
 
-def publish_workbook(server, auth_token, site_id, workbook_filename, dest_project_id):
+def _upload_chunks(session, server, site_id, chunks):
+    """
+    Uploads a workbook in chunks to a new file upload session.
+
+    'session'       session used to make requests to the server
+    'server'        specified server address
+    'site_id'       ID of the site that the user is signed into
+    'chunks'        iterable of the byte chunks of the workbook, in order
+    Returns the ID of the upload session holding the uploaded workbook.
+    """
+    # Initiates an upload session
+    upload_id = start_upload_session(session, server, site_id)
+
+    # URL for PUT request to append chunks for publishing
+    put_url = server + "/api/{0}/sites/{1}/fileUploads/{2}".format(VERSION, site_id, upload_id)
+
+    # The multipart framing is the same for every chunk, so it is built once
+    prelude, trailer, content_type = _make_frame({'request_payload': ('', '', 'text/xml'),
+                                                  'tableau_file': ('file', FILE_PLACEHOLDER, 'application/octet-stream')})
+
+    # Uploads the chunks of the workbook, reading the next chunk during each upload
+    for data in _read_ahead(chunks):
+        print("\tPublishing a chunk...")
+        server_response = session.put(put_url, data=_ChunkBody(prelude, data, trailer),
+                                      headers={"content-type": content_type})
+        _check_status(server_response, 200)
+    return upload_id
+
+
+def publish_workbook(session, server, site_id, workbook_filename, dest_project_id, workbook_stream):
     """
     Publishes the workbook to the desired project.
 
+    'session'           session used to make requests to the server
     'server'            specified server address
-    'auth_token'        authentication token that grants user access to API calls
     'site_id'           ID of the site that the user is signed into
     'workbook_filename' filename of workbook to publish
     'dest_project_id'   ID of peoject to publish to
+    'workbook_stream'   streamed download of the workbook to publish
     """
-    workbook_name, file_extension = workbook_filename.split('.', 1)
-    workbook_size = os.path.getsize(workbook_filename)
-    chunked = workbook_size >= FILESIZE_LIMIT
+    # Split on the last dot only, so names such as 'Sales.v2.twbx' keep their full name
+    workbook_name, file_extension = os.path.splitext(os.path.basename(workbook_filename))
+    file_extension = quote(file_extension.lstrip('.'), safe='')
+
+    # The size is known from the headers before any of the body is read. A download
+    # without a Content-Length, or a compressed one, could be any size once it is
+    # decoded, so it is uploaded in chunks rather than read into memory.
+    content_length = workbook_stream.headers.get('Content-Length')
+    if content_length is None or 'Content-Encoding' in workbook_stream.headers:
+        chunked = True
+    else:
+        chunked = int(content_length) >= FILESIZE_LIMIT
 
     # Build a general request for publishing
-    xml_request = ET.Element('tsRequest')
-    workbook_element = ET.SubElement(xml_request, 'workbook', name=workbook_name)
-    ET.SubElement(workbook_element, 'project', id=dest_project_id)
-    xml_request = ET.tostring(xml_request)
+    xml_request = PUBLISH_TEMPLATE.format(quoteattr(workbook_name), quoteattr(dest_project_id)).encode('utf-8')
 
     if chunked:
-        print("\tPublishing '{0}' in {1}MB chunks (workbook over 64MB):".format(workbook_name, CHUNK_SIZE / 1024000))
-        # Initiates an upload session
-        upload_id = start_upload_session(server, auth_token, site_id)
-
-        # URL for PUT request to append chunks for publishing
-        put_url = server + "/api/{0}/sites/{1}/fileUploads/{2}".format(VERSION, site_id, upload_id)
-
-        # Reads and uploads chunks of the workbook
-        with open(workbook_filename, 'rb') as f:
-            while True:
-                data = f.read(CHUNK_SIZE)
-                if not data:
-                    break
-                payload, content_type = _make_multipart({'request_payload': ('', '', 'text/xml'),
-                                                         'tableau_file': ('file', data, 'application/octet-stream')})
-                print("\tPublishing a chunk...")
-                server_response = requests.put(put_url, data=payload,
-                                               headers={'x-tableau-auth': auth_token, "content-type": content_type})
-                _check_status(server_response, 200)
+        print("\tPublishing '{0}' in {1}MB chunks (workbook over 64MB or of unknown size):".format(workbook_name, CHUNK_SIZE / 1024000))
+        # Each chunk is uploaded as soon as it has been downloaded from the source
+        with workbook_stream:
+            upload_id = _upload_chunks(session, server, site_id,
+                                       workbook_stream.iter_content(CHUNK_SIZE))
 
         # Finish building request for chunking method
         payload, content_type = _make_multipart({'request_payload': ('', xml_request, 'text/xml')})
@@ -319,43 +550,39 @@ def publish_workbook(server, auth_token, site_id, workbook_filename, dest_projec
     else:
         print("\tPublishing '{0}' using the all-in-one method (workbook under 64MB)".format(workbook_name))
 
-        # Read the contents of the file to publish
-        with open(workbook_filename, 'rb') as f:
-            workbook_bytes = f.read()
-
-        # Finish building request for all-in-one method
+        # Finish building request for all-in-one method. The workbook is under
+        # 64MB, so it is read into memory and sent between the multipart framing.
+        with workbook_stream:
+            workbook_bytes = workbook_stream.content
         parts = {'request_payload': ('', xml_request, 'text/xml'),
-                 'tableau_workbook': (workbook_filename, workbook_bytes, 'application/octet-stream')}
-        payload, content_type = _make_multipart(parts)
+                 'tableau_workbook': (workbook_filename, FILE_PLACEHOLDER, 'application/octet-stream')}
+        prelude, trailer, content_type = _make_frame(parts)
+        payload = _ChunkBody(prelude, workbook_bytes, trailer)
 
         publish_url = server + "/api/{0}/sites/{1}/workbooks".format(VERSION, site_id)
         publish_url += "?workbookType={0}&overwrite=true".format(file_extension)
 
     # Make the request to publish and check status code
     print("\tUploading...")
-    server_response = requests.post(publish_url, data=payload,
-                                    headers={'x-tableau-auth': auth_token, 'content-type': content_type})
+    server_response = session.post(publish_url, data=payload,
+                                   headers={'content-type': content_type})
     _check_status(server_response, 201)
 
 
-def delete_workbook(server, auth_token, site_id, workbook_id, workbook_filename):
+def delete_workbook(session, server, site_id, workbook_id):
     """
-    Deletes the temp workbook file, and workbook from the source project.
+    Deletes the workbook from the source project.
 
+    'session'           session used to make requests to the server
     'server'            specified server address
-    'auth_token'        authentication token that grants user access to API calls
     'site_id'           ID of the site that the user is signed into
     'workbook_id'       ID of workbook to delete
-    'workbook_filename' filename of temp workbook file to delete
     """
     # Builds the request to delete workbook from the source project on server
     url = server + "/api/{0}/sites/{1}/workbooks/{2}".format(VERSION, site_id, workbook_id)
-    server_response = requests.delete(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.delete(url)
     _check_status(server_response, 204)
 
-    # Remove the temp file created for the download
-    os.remove(workbook_filename)
-
 
 def main():
     ##### STEP 0: Initialization #####
@@ -374,36 +601,48 @@ def main():
 
     ##### STEP 1: Sign in #####
     print("\n1. Signing in to both sites to obtain authentication tokens")
-    # Source server
-    source_auth_token, source_site_id, source_user_id = sign_in(source_server, source_username, source_password)
+    # Each server gets its own session so connections to it are reused
+    source_session = _make_session()
+    dest_session = _make_session()
+
+    # Source server, signed in to in the background while signing in to the destination
+    wait_for_source = _start_in_background(sign_in, source_session, source_server, source_username, source_password)
 
     # Destination server
-    dest_auth_token, dest_site_id, dest_user_id = sign_in(dest_server, dest_username, dest_password)
+    dest_site_id, dest_user_id = sign_in(dest_session, dest_server, dest_username, dest_password)
+    source_site_id, source_user_id = wait_for_source()
 
     ##### STEP 2: Find workbook id #####
     print("\n2. Finding workbook id of '{0}'".format(workbook_name))
-    workbook_id = get_workbook_id(source_server, source_auth_token, source_user_id, source_site_id, workbook_name)
+    workbook_id = get_workbook_id(source_session, source_server, source_user_id, source_site_id, workbook_name)
 
     ##### STEP 3: Find 'default' project id for destination server #####
     print("\n3. Finding 'default' project id for {0}".format(dest_server))
-    dest_project_id = get_default_project_id(dest_server, dest_auth_token, dest_site_id)
+    dest_project_id = get_default_project_id(dest_session, dest_server, dest_site_id)
 
     ##### STEP 4: Download workbook #####
     print("\n4. Downloading the workbook to move")
-    workbook_filename = download(source_server, source_auth_token, source_site_id, workbook_id)
+    workbook_filename, workbook_stream = download(source_session, source_server, source_site_id, workbook_id)
 
     ##### STEP 5: Publish to new site #####
     print("\n5. Publishing workbook to {0}".format(dest_server))
-    publish_workbook(dest_server, dest_auth_token, dest_site_id, workbook_filename, dest_project_id)
+    publish_workbook(dest_session, dest_server, dest_site_id, workbook_filename,
+                     dest_project_id, workbook_stream)
 
     ##### STEP 6: Deleting workbook from the source site #####
-    print("\n6. Deleting workbook from the original site and temp file")
-    delete_workbook(source_server, source_auth_token, source_site_id, workbook_id, workbook_filename)
+    print("\n6. Deleting workbook from the original site")
+
+    # The source server is no longer needed once the workbook is published, so it is
+    # cleaned up and signed out of while the destination is signed out of below
+    def finish_source():
+        delete_workbook(source_session, source_server, source_site_id, workbook_id)
+        sign_out(source_session, source_server)
+    wait_for_source = _start_in_background(finish_source)
 
     ##### STEP 7: Sign out #####
     print("\n7. Signing out and invalidating the authentication token")
-    sign_out(source_server, source_auth_token)
-    sign_out(dest_server, dest_auth_token)
+    sign_out(dest_session, dest_server)
+    wait_for_source()
 
 
 if __name__ == "__main__":
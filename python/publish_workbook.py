@@ -28,11 +28,26 @@
 
 from version import VERSION
 import requests # Contains methods used to make HTTP requests
-import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+try:
+    from lxml import etree as ET # Contains methods used to build and parse XML (libxml2-backed)
+except ImportError:
+    import xml.etree.ElementTree as ET # Falls back to the standard library parser
 import sys
 import os
-import math
 import getpass
+from xml.sax.saxutils import quoteattr # Escapes values placed in XML attributes
+import threading
+try:
+    import queue
+    from urllib.parse import quote
+except ImportError:
+    import Queue as queue  # Python 2.7
+    from urllib import quote
+
+# Used to keep the connection to the server alive across requests, and to retry
+# requests that fail because of a dropped connection or a busy server
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 # The following packages are used to build a multi-part/mixed request.
 # They are contained in the 'requests' library
@@ -43,12 +58,29 @@ from requests.packages.urllib3.filepost import encode_multipart_formdata
 # or 'http://tableau.com/api' for Tableau Server 9.1 or later
 xmlns = {'t': 'http://tableau.com/api'}
 
+# Request body templates
+SIGN_IN_TEMPLATE = '<tsRequest><credentials name={0} password={1}><site contentUrl={2}/></credentials></tsRequest>'
+PUBLISH_TEMPLATE = '<tsRequest><workbook name={0}><project id={1}/></workbook></tsRequest>'
+
+# Qualified tag names, for matching elements while a response is parsed incrementally
+PROJECT_TAG = '{{{0}}}project'.format(xmlns['t'])
+PAGINATION_TAG = '{{{0}}}pagination'.format(xmlns['t'])
+
 # The maximum size of a file that can be published in a single request is 64MB
 FILESIZE_LIMIT = 1024 * 1024 * 64   # 64MB
 
 # For when a workbook is over 64MB, break it into 5MB(standard chunk size) chunks
 CHUNK_SIZE = 1024 * 1024 * 5    # 5MB
 
+# Size of the blocks a file is read in while it is streamed to the server
+STREAM_BLOCK_SIZE = 1024 * 64   # 64KB
+
+# Number of chunks read ahead while the current chunk is being uploaded
+READ_AHEAD_CHUNKS = 2
+
+# Stands in for the file data while the multipart framing around it is built
+FILE_PLACEHOLDER = b'--tableau-file-data--'
+
 # If using python version 3.x, 'raw_input()' is changed to 'input()'
 if sys.version[0] == '3': raw_input=input
 
@@ -64,7 +96,8 @@ class UserDefinedFieldError(Exception):
 def _encode_for_display(text):
     """
     Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions. 
+    Responses are parsed from their raw bytes, so this is only needed for text
+    that is shown to the user.
     
     Returns an ASCII-encoded version of the text.
     Unicode characters are converted to ASCII placeholders (for example, "?").
@@ -94,6 +127,126 @@ def _make_multipart(parts):
     return post_body, content_type
 
 
+def _make_frame(parts):
+    """
+    Creates the multipart framing around data that is sent separately.
+
+    'parts' is a dictionary in the same format as for _make_multipart, where the
+    body of the part whose data is sent separately is FILE_PLACEHOLDER.
+
+    Returns the bytes that go before the data, the bytes that go after it,
+    and the content type string.
+    """
+    post_body, content_type = _make_multipart(parts)
+    prelude, trailer = post_body.split(FILE_PLACEHOLDER)
+    return prelude, trailer, content_type
+
+
+class _ChunkBody(object):
+    """
+    Request body for one chunk of a chunked upload.
+
+    The framing and the chunk data are handed to requests as separate pieces,
+    so the chunk is written to the socket without first being copied into a
+    single multipart body. Defining the length lets requests send a
+    Content-Length header instead of using chunked transfer encoding.
+    """
+    def __init__(self, prelude, data, trailer):
+        self.parts = [part for part in (prelude, data, trailer) if part]
+
+    def read(self, size=-1):
+        # http.client (httplib on Python 2.7) calls read() until it returns
+        # nothing. Each piece is returned whole, whatever size is asked for, so
+        # it reaches the socket in one call.
+        return self.parts.pop(0) if self.parts else b''
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+
+class _FileBody(object):
+    """
+    Request body that streams a file from disk between its multipart framing.
+
+    The file is read in STREAM_BLOCK_SIZE blocks as it is sent, so it is never
+    held in memory as a whole.
+    """
+    def __init__(self, prelude, filename, trailer):
+        self.prelude = prelude
+        self.filename = filename
+        self.trailer = trailer
+        self.blocks = None
+
+    def _iter_blocks(self):
+        yield self.prelude
+        with open(self.filename, 'rb') as f:
+            for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b''):
+                yield block
+        yield self.trailer
+
+    def read(self, size=-1):
+        # http.client (httplib on Python 2.7) calls read() until it returns
+        # nothing. Each call returns a whole block rather than the 8KB asked for.
+        if self.blocks is None:
+            self.blocks = self._iter_blocks()
+        return next(self.blocks, b'')
+
+    def __len__(self):
+        return len(self.prelude) + os.path.getsize(self.filename) + len(self.trailer)
+
+
+def _read_ahead(chunks):
+    """
+    Iterates over 'chunks' while the following chunks are read on another thread.
+
+    Tableau appends the chunks of an upload session in the order they arrive,
+    so they cannot be uploaded in parallel. Reading the next chunk while the
+    current one is being uploaded still keeps the network busy instead of
+    waiting on the read between every request. At most READ_AHEAD_CHUNKS
+    chunks are held in memory at a time.
+
+    If the upload stops early, the reader is stopped and waited for before
+    the caller goes on to close the source the chunks are read from.
+
+    'chunks'    iterable of the byte chunks to upload
+    """
+    buffered = queue.Queue(maxsize=READ_AHEAD_CHUNKS)
+    stopped = threading.Event()
+
+    def fill():
+        try:
+            for chunk in chunks:
+                buffered.put(chunk)
+                # Exit before the next read if the upload has stopped
+                if stopped.is_set():
+                    return
+        except Exception as error:
+            # Hand the error to the uploading thread instead of losing it here
+            buffered.put(error)
+        buffered.put(None)
+
+    reader = threading.Thread(target=fill)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            chunk = buffered.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # Keep taking chunks off the queue until the reader exits, so it is
+        # never left waiting to add a chunk that will not be uploaded
+        stopped.set()
+        while reader.is_alive():
+            try:
+                buffered.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
 def _check_status(server_response, success_code):
     """
     Checks the server response for possible errors.
@@ -103,7 +256,7 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        parsed_response = ET.fromstring(server_response.content)
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -115,14 +268,30 @@ def _check_status(server_response, success_code):
         summary = summary_element.text if summary_element is not None else 'unknown summary'
         detail = detail_element.text if detail_element is not None else 'unknown detail'
         error_message = '{0}: {1} - {2}'.format(code, summary, detail)
-        raise ApiCallError(error_message)
+        raise ApiCallError(_encode_for_display(error_message))
     return
 
 
-def sign_in(server, username, password, site=""):
+def _make_session():
+    """
+    Creates a session that reuses its connection to the server.
+    Chunk uploads are not retried, as a resent chunk would be appended twice.
+    Returns the new session.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
 
+    'session'  session used to make requests to the server
     'server'   specified server address
     'username' is the name (not ID) of the user to sign in as.
                Note that most of the functions in this example require that the user
@@ -130,96 +299,91 @@ def sign_in(server, username, password, site=""):
     'password' is the password for the user.
     'site'     is the ID (as a string) of the site on the server to sign in to. The
                default is "", which signs in to the default site.
-    Returns the authentication token and the site ID.
+    The authentication token is sent with every later request made through the session.
+    Returns the site ID.
     """
     url = server + "/api/{0}/auth/signin".format(VERSION)
 
     # Builds the request
-    xml_request = ET.Element('tsRequest')
-    credentials_element = ET.SubElement(xml_request, 'credentials', name=username, password=password)
-    ET.SubElement(credentials_element, 'site', contentUrl=site)
-    xml_request = ET.tostring(xml_request)
+    xml_request = SIGN_IN_TEMPLATE.format(quoteattr(username), quoteattr(password), quoteattr(site)).encode('utf-8')
 
     # Make the request to server
-    server_response = requests.post(url, data=xml_request)
+    server_response = session.post(url, data=xml_request)
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Gets the auth token and site ID
-    token = parsed_response.find('t:credentials', namespaces=xmlns).get('token')
-    site_id = parsed_response.find('.//t:site', namespaces=xmlns).get('id')
-    return token, site_id
+    credentials_element = parsed_response.find('t:credentials', namespaces=xmlns)
+    token = credentials_element.get('token')
+    site_id = credentials_element.find('t:site', namespaces=xmlns).get('id')
+    session.headers['x-tableau-auth'] = token
+    return site_id
 
 
-def sign_out(server, auth_token):
+def sign_out(session, server):
     """
     Destroys the active session and invalidates authentication token.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 204)
+    del session.headers['x-tableau-auth']
     return
 
 
-def start_upload_session(server, auth_token, site_id):
+def start_upload_session(session, server, site_id):
     """
     Creates a POST request that initiates a file upload session.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     Returns a session ID that is used by subsequent functions to identify the upload session.
     """
     url = server + "/api/{0}/sites/{1}/fileUploads".format(VERSION, site_id)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 201)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = ET.fromstring(server_response.content)
     return xml_response.find('t:fileUpload', namespaces=xmlns).get('uploadSessionId')
 
 
-def get_default_project_id(server, auth_token, site_id):
+def get_default_project_id(session, server, site_id):
     """
     Returns the project ID for the 'default' project on the Tableau server.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     """
-    page_num, page_size = 1, 100   # Default paginating values
+    page_num, page_size = 1, 1000  # Largest page size the REST API allows, to keep round trips down
 
-    # Builds the request
     url = server + "/api/{0}/sites/{1}/projects".format(VERSION, site_id)
-    paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-    server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-
-    # Used to determine if more requests are required to find all projects on server
-    total_projects = int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
-    max_page = int(math.ceil(total_projects / page_size))
-
-    projects = xml_response.findall('.//t:project', namespaces=xmlns)
-
-    # Continue querying if more projects exist on the server
-    for page in range(2, max_page + 1):
-        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page)
-        server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
-        _check_status(server_response, 200)
-        xml_response = ET.fromstring(_encode_for_display(server_response.text))
-        projects.extend(xml_response.findall('.//t:project', namespaces=xmlns))
-
-    # Look through all projects to find the 'default' one
-    for project in projects:
-        if project.get('name') == 'default' or project.get('name') == 'Default':
-            return project.get('id')
+    while True:
+        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+        # Parse the page as it arrives, clearing each project once it has been
+        # checked, and stop at the 'default' one without reading any further
+        with session.get(paged_url, stream=True) as server_response:
+            _check_status(server_response, 200)
+            server_response.raw.decode_content = True
+            total_projects = 0
+            for _, element in ET.iterparse(server_response.raw):
+                if element.tag == PAGINATION_TAG:
+                    total_projects = int(element.get('totalAvailable'))
+                elif element.tag == PROJECT_TAG:
+                    if element.get('name') == 'default' or element.get('name') == 'Default':
+                        return element.get('id')
+                    element.clear()
+
+        # Stop once every project on the server has been looked at
+        if page_num * page_size >= total_projects:
+            break
+        page_num += 1
     raise LookupError("Project named 'default' was not found on server")
 
 
@@ -243,8 +407,9 @@ def main():
         error = "{0}: file not found".format(workbook_file_path)
         raise IOError(error)
 
-    # Break workbook file by name and extension
-    workbook_filename, file_extension = workbook_file.split('.', 1)
+    # Break workbook file by name and extension, splitting on the last dot only
+    workbook_filename, file_extension = os.path.splitext(workbook_file)
+    file_extension = quote(file_extension.lstrip('.'), safe='')
 
     if file_extension != 'twbx':
         error = "This sample only accepts .twbx files to publish. More information in file comments."
@@ -256,38 +421,43 @@ def main():
 
     ##### STEP 1: SIGN IN #####
     print("\n1. Signing in as " + username)
-    auth_token, site_id = sign_in(server, username, password)
+    # Every request goes through one session, so the connection to the server is reused
+    session = _make_session()
+    site_id = sign_in(session, server, username, password)
 
     ##### STEP 2: OBTAIN DEFAULT PROJECT ID #####
     print("\n2. Finding the 'default' project to publish to")
-    project_id = get_default_project_id(server, auth_token, site_id)
+    project_id = get_default_project_id(session, server, site_id)
 
     ##### STEP 3: PUBLISH WORKBOOK ######
     # Build a general request for publishing
-    xml_request = ET.Element('tsRequest')
-    workbook_element = ET.SubElement(xml_request, 'workbook', name=workbook_filename)
-    ET.SubElement(workbook_element, 'project', id=project_id)
-    xml_request = ET.tostring(xml_request)
+    xml_request = PUBLISH_TEMPLATE.format(quoteattr(workbook_filename), quoteattr(project_id)).encode('utf-8')
 
     if chunked:
         print("\n3. Publishing '{0}' in {1}MB chunks (workbook over 64MB)".format(workbook_file, CHUNK_SIZE / 1024000))
         # Initiates an upload session
-        uploadID = start_upload_session(server, auth_token, site_id)
+        uploadID = start_upload_session(session, server, site_id)
 
         # URL for PUT request to append chunks for publishing
         put_url = server + "/api/{0}/sites/{1}/fileUploads/{2}".format(VERSION, site_id, uploadID)
 
-        # Read the contents of the file in chunks of 100KB
+        # The multipart framing is the same for every chunk, so it is built once
+        prelude, trailer, content_type = _make_frame({'request_payload': ('', '', 'text/xml'),
+                                                      'tableau_file': ('file', FILE_PLACEHOLDER, 'application/octet-stream')})
+
+        # Reads the workbook file and uploads it in chunks of 5MB, each sent between
+        # the framing without being joined into one body. The chunks must be
+        # appended in order, so they are uploaded one at a time while the next
+        # ones are read from disk.
         with open(workbook_file_path, 'rb') as f:
-            while True:
-                data = f.read(CHUNK_SIZE)
-                if not data:
-                    break
-                payload, content_type = _make_multipart({'request_payload': ('', '', 'text/xml'),
-                                                         'tableau_file': ('file', data, 'application/octet-stream')})
+            # The file is read front to back, so let the kernel read ahead further
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            chunks = iter(lambda: f.read(CHUNK_SIZE), b'')
+            for data in _read_ahead(chunks):
                 print("\tPublishing a chunk...")
-                server_response = requests.put(put_url, data=payload,
-                                               headers={'x-tableau-auth': auth_token, "content-type": content_type})
+                server_response = session.put(put_url, data=_ChunkBody(prelude, data, trailer),
+                                              headers={"content-type": content_type})
                 _check_status(server_response, 200)
 
         # Finish building request for chunking method
@@ -298,28 +468,25 @@ def main():
         publish_url += "&workbookType={0}&overwrite=true".format(file_extension)
     else:
         print("\n3. Publishing '" + workbook_file + "' using the all-in-one method (workbook under 64MB)")
-        # Read the contents of the file to publish
-        with open(workbook_file_path, 'rb') as f:
-            workbook_bytes = f.read()
-
-        # Finish building request for all-in-one method
+        # Finish building request for all-in-one method. The workbook is streamed
+        # from disk between the multipart framing as the request is sent, rather
+        # than read into memory first.
         parts = {'request_payload': ('', xml_request, 'text/xml'),
-                 'tableau_workbook': (workbook_file, workbook_bytes, 'application/octet-stream')}
-        payload, content_type = _make_multipart(parts)
+                 'tableau_workbook': (workbook_file, FILE_PLACEHOLDER, 'application/octet-stream')}
+        prelude, trailer, content_type = _make_frame(parts)
+        payload = _FileBody(prelude, workbook_file_path, trailer)
 
         publish_url = server + "/api/{0}/sites/{1}/workbooks".format(VERSION, site_id)
         publish_url += "?workbookType={0}&overwrite=true".format(file_extension)
 
     # Make the request to publish and check status code
     print("\tUploading...")
-    server_response = requests.post(publish_url, data=payload,
-                                    headers={'x-tableau-auth': auth_token, 'content-type': content_type})
+    server_response = session.post(publish_url, data=payload, headers={'content-type': content_type})
     _check_status(server_response, 201)
 
     ##### STEP 4: SIGN OUT #####
     print("\n4. Signing out, and invalidating the authentication token")
-    sign_out(server, auth_token)
-    auth_token = None
+    sign_out(session, server)
 
 
 if __name__ == '__main__':
@@ -31,14 +31,31 @@
 
 from version import VERSION
 import requests # Contains methods used to make HTTP requests
-import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+try:
+    from lxml import etree as ET # Contains methods used to build and parse XML (libxml2-backed)
+except ImportError:
+    import xml.etree.ElementTree as ET # Falls back to the standard library parser
 import sys
 import getpass
+from xml.sax.saxutils import quoteattr # Escapes values placed in XML attributes
+from multiprocessing.pool import ThreadPool # Thread-backed pool, available on Python 2.7 and 3
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote  # Python 2.7
 
 # The namespace for the REST API is 'http://tableausoftware.com/api' for Tableau Server 9.0
 # or 'http://tableau.com/api' for Tableau Server 9.1 or later
 xmlns = {'t': 'http://tableau.com/api'}
 
+# Request body templates
+SIGN_IN_TEMPLATE = '<tsRequest><credentials name={0} password={1}><site contentUrl={2}/></credentials></tsRequest>'
+PERMISSION_TEMPLATE = ('<tsRequest><permissions><workbook id={0}/><granteeCapabilities><user id={1}/>'
+                       '<capabilities><capability name={2} mode={3}/></capabilities>'
+                       '</granteeCapabilities></permissions></tsRequest>')
+
 # All possible permission names
 permissions = {"Read", "Write", "Filter", "AddComment", "ViewComments", "ShareView", "ExportData", "ViewUnderlyingData",
                "ExportImage", "Delete", "ChangeHierarchy", "ChangePermissions", "WebAuthoring", "ExportXml"}
@@ -46,6 +63,9 @@ permissions = {"Read", "Write", "Filter", "AddComment", "ViewComments", "ShareVi
 # Possible modes for to set the permissions
 modes = {"Allow", "Deny"}
 
+# Number of workbooks whose permissions are updated at the same time
+UPDATE_WORKERS = 8
+
 # If using python version 3.x, 'raw_input()' is changed to 'input()'
 if sys.version[0] == '3': raw_input=input
 
@@ -61,7 +81,8 @@ class UserDefinedFieldError(Exception):
 def _encode_for_display(text):
     """
     Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
+    Responses are parsed from their raw bytes, so this is only needed for text
+    that is shown to the user.
 
     Returns an ASCII-encoded version of the text.
     Unicode characters are converted to ASCII placeholders (for example, "?").
@@ -78,7 +99,7 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        parsed_response = ET.fromstring(server_response.content)
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -90,14 +111,30 @@ def _check_status(server_response, success_code):
         summary = summary_element.text if summary_element is not None else 'unknown summary'
         detail = detail_element.text if detail_element is not None else 'unknown detail'
         error_message = '{0}: {1} - {2}'.format(code, summary, detail)
-        raise ApiCallError(error_message)
+        raise ApiCallError(_encode_for_display(error_message))
     return
 
 
-def sign_in(server, username, password, site=""):
+def _make_session():
+    """
+    Creates a session that reuses its connections to the server,
+    keeping one for each of the UPDATE_WORKERS threads.
+    Returns the new session.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPDATE_WORKERS, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
 
+    'session'  session used to make requests to the server
     'server'   specified server address
     'username' is the name (not ID) of the user to sign in as.
                Note that most of the functions in this example require that the user
@@ -105,59 +142,60 @@ def sign_in(server, username, password, site=""):
     'password' is the password for the user.
     'site'     is the ID (as a string) of the site on the server to sign in to. The
                default is "", which signs in to the default site.
-    Returns the authentication token and the site ID.
+    The authentication token is sent with every later request made through the session.
+    Returns the site ID and the user ID.
     """
     url = server + "/api/{0}/auth/signin".format(VERSION)
 
     # Builds the request
-    xml_request = ET.Element('tsRequest')
-    credentials_element = ET.SubElement(xml_request, 'credentials', name=username, password=password)
-    ET.SubElement(credentials_element, 'site', contentUrl=site)
-    xml_request = ET.tostring(xml_request)
+    xml_request = SIGN_IN_TEMPLATE.format(quoteattr(username), quoteattr(password), quoteattr(site)).encode('utf-8')
 
     # Make the request to server
-    server_response = requests.post(url, data=xml_request)
+    server_response = session.post(url, data=xml_request)
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Gets the auth token and site ID
-    token = parsed_response.find('t:credentials', namespaces=xmlns).get('token')
-    site_id = parsed_response.find('.//t:site', namespaces=xmlns).get('id')
-    user_id = parsed_response.find('.//t:user', namespaces=xmlns).get('id')
-    return token, site_id, user_id
+    credentials_element = parsed_response.find('t:credentials', namespaces=xmlns)
+    token = credentials_element.get('token')
+    site_id = credentials_element.find('t:site', namespaces=xmlns).get('id')
+    user_id = credentials_element.find('t:user', namespaces=xmlns).get('id')
+    session.headers['x-tableau-auth'] = token
+    return site_id, user_id
 
 
-def sign_out(server, auth_token):
+def sign_out(session, server):
     """
     Destroys the active session and invalidates authentication token.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 204)
+    del session.headers['x-tableau-auth']
     return
 
 
-def get_user_id(server, auth_token, site_id, username_to_update):
+def get_user_id(session, server, site_id, username_to_update):
     """
     Returns the user id of the user to update permissions for, if found.
 
+    'session'               session used to make requests to the server
     'server'                specified server address
-    'auth_token'            authentication token that grants user access to API calls
     'site_id'               ID of the site that the user is signed into
     'username_to_update'    username to update permission for on server
     """
+    # Let the server filter by name, so only the matching user is returned rather
+    # than a single page of every user on the site
     url = server + "/api/{0}/sites/{1}/users".format(VERSION, site_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
+    url += "?filter=name:eq:{0}".format(quote(username_to_update, safe=''))
+    server_response = session.get(url)
     _check_status(server_response, 200)
-    server_response = ET.fromstring(_encode_for_display(server_response.text))
+    server_response = ET.fromstring(server_response.content)
 
     # Find all user tags in the response and look for matching id
     users = server_response.findall('.//t:user', namespaces=xmlns)
@@ -168,49 +206,59 @@ def get_user_id(server, auth_token, site_id, username_to_update):
     raise LookupError(error)
 
 
-def get_workbooks(server, auth_token, user_id, site_id):
+def get_workbooks(session, server, user_id, site_id):
     """
     Queries all existing workbooks on the current site.
 
+    'session'           session used to make requests to the server
     'server'            specified server address
-    'auth_token'        authentication token that grants user access to API calls
     'user_id'           ID of user with access to workbooks
     'site_id'           ID of the site that the user is signed into
     Returns tuples for each workbook, containing its id and name.
     """
+    page_num, page_size = 1, 1000   # Largest page size the REST API allows, to keep round trips down
+
+    # Tuples to store each workbook information:(workbook_id, workbook_name)
+    workbooks = []
     url = server + "/api/{0}/sites/{1}/users/{2}/workbooks".format(VERSION, site_id, user_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    server_response = ET.fromstring(_encode_for_display(server_response.text))
+    while True:
+        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
 
-    # Find all workbook ids
-    workbook_tags = server_response.findall('.//t:workbook', namespaces=xmlns)
+        server_response = session.get(paged_url)
+        _check_status(server_response, 200)
+        server_response = ET.fromstring(server_response.content)
+
+        # Find all workbook ids on this page
+        workbook_tags = server_response.findall('.//t:workbook', namespaces=xmlns)
+        workbooks.extend((workbook.get('id'), workbook.get('name')) for workbook in workbook_tags)
+
+        # Stop once every workbook has been read, rather than only the first page
+        total_workbooks = int(server_response.find('.//t:pagination', namespaces=xmlns).get('totalAvailable'))
+        if page_num * page_size >= total_workbooks:
+            break
+        page_num += 1
 
-    # Tuples to store each workbook information:(workbook_id, workbook_name)
-    workbooks = [(workbook.get('id'), workbook.get('name')) for workbook in workbook_tags]
     if len(workbooks) == 0:
         error = "No workbooks found on this site"
         raise LookupError(error)
     return workbooks
 
 
-def query_permission(server, auth_token, site_id, workbook_id, user_id):
+def query_permission(session, server, site_id, workbook_id, user_id):
     """
     Returns a list of all permissions for the specified user.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     'workbook_id'   ID of workbook to update permission in
     'user_id'       ID of the user to update
     """
     url = server + "/api/{0}/sites/{1}/workbooks/{2}/permissions".format(VERSION, site_id, workbook_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.get(url)
     _check_status(server_response, 200)
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Find all the capabilities for a specific user
     capabilities = parsed_response.findall('.//t:granteeCapabilities', namespaces=xmlns)
@@ -221,12 +269,12 @@ def query_permission(server, auth_token, site_id, workbook_id, user_id):
     return None
 
 
-def add_permission(server, auth_token, site_id, workbook_id, user_id, permission_name, permission_mode):
+def add_permission(session, server, site_id, workbook_id, user_id, permission_name, permission_mode):
     """
     Adds the specified permission to the workbook for the desired user.
 
+    'session'           session used to make requests to the server
     'server'            specified server address
-    'auth_token'        authentication token that grants user access to API calls
     'site_id'           ID of the site that the user is signed into
     'workbook_id'       ID of workbook to update permission in
     'user_id'           ID of the user to update
@@ -236,26 +284,20 @@ def add_permission(server, auth_token, site_id, workbook_id, user_id, permission
     url = server + "/api/{0}/sites/{1}/workbooks/{2}/permissions".format(VERSION, site_id, workbook_id)
 
     # Build the request
-    xml_request = ET.Element('tsRequest')
-    permissions_element = ET.SubElement(xml_request, 'permissions')
-    ET.SubElement(permissions_element, 'workbook', id=workbook_id)
-    grantee_element = ET.SubElement(permissions_element, 'granteeCapabilities')
-    ET.SubElement(grantee_element, 'user', id=user_id)
-    capabilities_element = ET.SubElement(grantee_element, 'capabilities')
-    ET.SubElement(capabilities_element, 'capability', name=permission_name, mode=permission_mode)
-    xml_request = ET.tostring(xml_request)
-
-    server_request = requests.put(url, data=xml_request, headers={'x-tableau-auth': auth_token})
+    xml_request = PERMISSION_TEMPLATE.format(quoteattr(workbook_id), quoteattr(user_id),
+                                             quoteattr(permission_name), quoteattr(permission_mode)).encode('utf-8')
+
+    server_request = session.put(url, data=xml_request)
     _check_status(server_request, 200)
     return
 
 
-def delete_permission(server, auth_token, site_id, workbook_id, user_id, permission_name, existing_mode):
+def delete_permission(session, server, site_id, workbook_id, user_id, permission_name, existing_mode):
     """
     Deletes a specific permission from the workbook.
 
+    'session'           session used to make requests to the server
     'server'            specified server address
-    'auth_token'        authentication token that grants user access to API calls
     'site_id'           ID of the site that the user is signed into
     'workbook_id'       ID of workbook to update permission in
     'user_id'           ID of the user to update
@@ -268,12 +310,47 @@ def delete_permission(server, auth_token, site_id, workbook_id, user_id, permiss
                                                                                            user_id,
                                                                                            permission_name,
                                                                                            existing_mode)
-    print("\tDeleting existing permission")
-    server_response = requests.delete(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.delete(url)
     _check_status(server_response, 204)
     return
 
 
+def update_workbook_permission(session, server, site_id, workbook_id, workbook_name,
+                               user_id, permission_name, permission_mode):
+    """
+    Sets the permission on a single workbook, replacing an existing permission
+    that has a different mode.
+
+    'session'           session used to make requests to the server
+    'server'            specified server address
+    'site_id'           ID of the site that the user is signed into
+    'workbook_id'       ID of workbook to update permission in
+    'workbook_name'     name of workbook, used in the returned message
+    'user_id'           ID of the user to update
+    'permission_name'   name of permission to add or update
+    'permission_mode'   mode to set the permission
+    Returns a message describing what was changed.
+    """
+    user_permissions = query_permission(session, server, site_id, workbook_id, user_id)
+    message = ""
+    update_permission = True
+    if user_permissions is not None:
+        for permission in user_permissions:
+            if permission.get('name') == permission_name:
+                if permission.get('mode') != permission_mode:
+                    existing_mode = permission.get('mode')
+                    delete_permission(session, server, site_id, workbook_id,
+                                      user_id, permission_name, existing_mode)
+                    message += "\tDeleting existing permission\n"
+                else:
+                    update_permission = False
+    if not update_permission:
+        return message + "\tPermission already set to {0} on {1}\n".format(permission_mode, _encode_for_display(workbook_name))
+    add_permission(session, server, site_id, workbook_id, user_id,
+                   permission_name, permission_mode)
+    return message + "\tSuccessfully added/updated permission in {0}\n".format(_encode_for_display(workbook_name))
+
+
 def main():
     ##### STEP 0: Initialization #####
     if len(sys.argv) != 3:
@@ -298,44 +375,41 @@ def main():
 
     ##### STEP 1: Sign in #####
     print("\n1. Signing in as " + server_username)
-    auth_token, site_id, user_id = sign_in(server, server_username, password)
+    session = _make_session()
+    site_id, user_id = sign_in(session, server, server_username, password)
 
     ##### STEP 2: Find id of username to update #####
     print("\n2. Finding user if of {0}".format(username_to_update))
-    user_id = get_user_id(server, auth_token, site_id, username_to_update)
+    user_id = get_user_id(session, server, site_id, username_to_update)
 
     ##### STEP 3: Find all workbooks in site #####
     print("\n3. Finding all the workbooks in the site")
-    workbook_ids = get_workbooks(server, auth_token, user_id, site_id)
+    workbook_ids = get_workbooks(session, server, user_id, site_id)
 
     ##### STEP 4: Query permissions #####
     print("\n4. Querying permissions for all workbooks and adding specified permission")
-    for workbook_id, workbook_name in workbook_ids:
-        user_permissions = query_permission(server, auth_token, site_id, workbook_id, user_id)
-        if user_permissions is None:
-            add_permission(server, auth_token, site_id, workbook_id,
-                           user_id, permission_name, permission_mode)
-            print("\tSuccessfully added/updated permission in {0}\n".format(workbook_name))
-        else:
-            update_permission = True
-            for permission in user_permissions:
-                if permission.get('name') == permission_name:
-                    if permission.get('mode') != permission_mode:
-                        existing_mode = permission.get('mode')
-                        delete_permission(server, auth_token, site_id, workbook_id,
-                                          user_id, permission_name, existing_mode)
-                    else:
-                        update_permission = False
-            if update_permission:
-                add_permission(server, auth_token, site_id, workbook_id, user_id,
-                               permission_name, permission_mode)
-                print("\tSuccessfully added/updated permission in {0}\n".format(workbook_name))
-            else:
-                print("\tPermission already set to {0} on {1}\n".format(permission_mode, workbook_name))
+
+    def update_workbook(workbook):
+        workbook_id, workbook_name = workbook
+        return update_workbook_permission(session, server, site_id, workbook_id, workbook_name,
+                                          user_id, permission_name, permission_mode)
+
+    # Each workbook's permissions are independent, so several are updated at once.
+    # imap() hands back each message in workbook order as soon as it is ready, so
+    # progress is shown as it happens and the updates made before a failure are
+    # still reported.
+    pool = ThreadPool(min(UPDATE_WORKERS, len(workbook_ids)))
+    try:
+        for message in pool.imap(update_workbook, workbook_ids):
+            print(message)
+    finally:
+        # If an update failed, the workbooks that have not been started are skipped
+        pool.terminate()
+        pool.join()
 
     ##### STEP 5: Sign out #####
     print("\n5. Signing out and invalidating the authentication token")
-    sign_out(server, auth_token)
+    sign_out(session, server)
 
 
 if __name__ == "__main__":
@@ -29,14 +29,34 @@
 
 from version import VERSION
 import requests # Contains methods used to make HTTP requests
-import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+try:
+    from lxml import etree as ET # Contains methods used to build and parse XML (libxml2-backed)
+except ImportError:
+    import xml.etree.ElementTree as ET # Falls back to the standard library parser
 import sys
 import getpass
+from xml.sax.saxutils import quoteattr # Escapes values placed in XML attributes
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote  # Python 2.7
 
 # The namespace for the REST API is 'http://tableausoftware.com/api' for Tableau Server 9.0
 # or 'http://tableau.com/api' for Tableau Server 9.1 or later
 xmlns = {'t': 'http://tableau.com/api'}
 
+# Request body templates
+SIGN_IN_TEMPLATE = '<tsRequest><credentials name={0} password={1}><site contentUrl={2}/></credentials></tsRequest>'
+PERMISSION_TEMPLATE = ('<tsRequest><permissions><workbook id={0}/><granteeCapabilities><user id={1}/>'
+                       '<capabilities><capability name={2} mode={3}/></capabilities>'
+                       '</granteeCapabilities></permissions></tsRequest>')
+
+# Qualified tag names, for matching elements while a response is parsed incrementally
+WORKBOOK_TAG = '{{{0}}}workbook'.format(xmlns['t'])
+PAGINATION_TAG = '{{{0}}}pagination'.format(xmlns['t'])
+
 # All possible permission names
 permissions = {"Read", "Write", "Filter", "AddComment", "ViewComments", "ShareView", "ExportData", "ViewUnderlyingData",
                "ExportImage", "Delete", "ChangeHierarchy", "ChangePermissions", "WebAuthoring", "ExportXml"}
@@ -59,7 +79,8 @@ class UserDefinedFieldError(Exception):
 def _encode_for_display(text):
     """
     Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
+    Responses are parsed from their raw bytes, so this is only needed for text
+    that is shown to the user.
 
     Returns an ASCII-encoded version of the text.
     Unicode characters are converted to ASCII placeholders (for example, "?").
@@ -76,7 +97,7 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        parsed_response = ET.fromstring(server_response.content)
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -88,14 +109,29 @@ def _check_status(server_response, success_code):
         summary = summary_element.text if summary_element is not None else 'unknown summary'
         detail = detail_element.text if detail_element is not None else 'unknown detail'
         error_message = '{0}: {1} - {2}'.format(code, summary, detail)
-        raise ApiCallError(error_message)
+        raise ApiCallError(_encode_for_display(error_message))
     return
 
 
-def sign_in(server, username, password, site=""):
+def _make_session():
+    """
+    Creates a session that reuses its connection to the server.
+    Returns the new session.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'], raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
 
+    'session'  session used to make requests to the server
     'server'   specified server address
     'username' is the name (not ID) of the user to sign in as.
                Note that most of the functions in this example require that the user
@@ -103,84 +139,99 @@ def sign_in(server, username, password, site=""):
     'password' is the password for the user.
     'site'     is the ID (as a string) of the site on the server to sign in to. The
                default is "", which signs in to the default site.
-    Returns the authentication token and the site ID.
+    The authentication token is sent with every later request made through the session.
+    Returns the site ID and the user ID.
     """
     url = server + "/api/{0}/auth/signin".format(VERSION)
 
     # Builds the request
-    xml_request = ET.Element('tsRequest')
-    credentials_element = ET.SubElement(xml_request, 'credentials', name=username, password=password)
-    ET.SubElement(credentials_element, 'site', contentUrl=site)
-    xml_request = ET.tostring(xml_request)
+    xml_request = SIGN_IN_TEMPLATE.format(quoteattr(username), quoteattr(password), quoteattr(site)).encode('utf-8')
 
     # Make the request to server
-    server_response = requests.post(url, data=xml_request)
+    server_response = session.post(url, data=xml_request)
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Gets the auth token and site ID
-    token = parsed_response.find('t:credentials', namespaces=xmlns).get('token')
-    site_id = parsed_response.find('.//t:site', namespaces=xmlns).get('id')
-    user_id = parsed_response.find('.//t:user', namespaces=xmlns).get('id')
-    return token, site_id, user_id
+    credentials_element = parsed_response.find('t:credentials', namespaces=xmlns)
+    token = credentials_element.get('token')
+    site_id = credentials_element.find('t:site', namespaces=xmlns).get('id')
+    user_id = credentials_element.find('t:user', namespaces=xmlns).get('id')
+    session.headers['x-tableau-auth'] = token
+    return site_id, user_id
 
 
-def sign_out(server, auth_token):
+def sign_out(session, server):
     """
     Destroys the active session and invalidates authentication token.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 204)
+    del session.headers['x-tableau-auth']
     return
 
 
-def get_workbook_id(server, auth_token, user_id, site_id, workbook_name):
+def get_workbook_id(session, server, user_id, site_id, workbook_name):
     """
     Gets the id of the desired workbook to relocate.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'user_id'       ID of user with access to workbooks
     'site_id'       ID of the site that the user is signed into
     'workbook_name' name of workbook to get ID of
     Returns the workbook id and the project id that contains the workbook.
     """
-    url = server + "/api/{0}/sites/{1}/users/{2}/workbooks".format(VERSION, site_id, user_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    page_num, page_size = 1, 1000   # Largest page size the REST API allows, to keep round trips down
 
-    # Find all workbooks in the site and look for the desired one
-    workbooks = xml_response.findall('.//t:workbook', namespaces=xmlns)
-    for workbook in workbooks:
-        if workbook.get('name') == workbook_name:
-            return workbook.get('id')
+    url = server + "/api/{0}/sites/{1}/users/{2}/workbooks".format(VERSION, site_id, user_id)
+    while True:
+        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
+
+        # Parse the page as it arrives, clearing each workbook once it has been
+        # checked, and stop at the workbook without reading any further
+        with session.get(paged_url, stream=True) as server_response:
+            _check_status(server_response, 200)
+            server_response.raw.decode_content = True
+            total_workbooks = 0
+            for _, element in ET.iterparse(server_response.raw):
+                if element.tag == PAGINATION_TAG:
+                    total_workbooks = int(element.get('totalAvailable'))
+                elif element.tag == WORKBOOK_TAG:
+                    if element.get('name') == workbook_name:
+                        return element.get('id')
+                    element.clear()
+
+        # Stop once every workbook the user can see has been looked at
+        if page_num * page_size >= total_workbooks:
+            break
+        page_num += 1
     error = "Workbook named '{0}' not found.".format(workbook_name)
     raise LookupError(error)
 
 
-def get_user_id(server, auth_token, site_id, username_to_audit):
+def get_user_id(session, server, site_id, username_to_audit):
     """
     Returns the user id of the user to audit permissions for, if found.
 
+    'session'               session used to make requests to the server
     'server'                specified server address
-    'auth_token'            authentication token that grants user access to API calls
     'site_id'               ID of the site that the user is signed into
     'username_to_audit'     username to audit permission for on server
     """
+    # Let the server filter by name, so only the matching user is returned rather
+    # than a single page of every user on the site
     url = server + "/api/{0}/sites/{1}/users".format(VERSION, site_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
+    url += "?filter=name:eq:{0}".format(quote(username_to_audit, safe=''))
+    server_response = session.get(url)
     _check_status(server_response, 200)
-    server_response = ET.fromstring(_encode_for_display(server_response.text))
+    server_response = ET.fromstring(server_response.content)
 
     # Find all user tags in the response and look for matching id
     users = server_response.findall('.//t:user', namespaces=xmlns)
@@ -191,23 +242,21 @@ def get_user_id(server, auth_token, site_id, username_to_audit):
     raise LookupError(error)
 
 
-def query_permission(server, auth_token, site_id, workbook_id, user_id):
+def query_permission(session, server, site_id, workbook_id, user_id):
     """
     Returns a list of all permissions for the specified user.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     'site_id'       ID of the site that the user is signed into
     'workbook_id'   ID of workbook to audit permission in
     'user_id'       ID of the user to audit
     """
     url = server + "/api/{0}/sites/{1}/workbooks/{2}/permissions".format(VERSION, site_id, workbook_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.get(url)
     _check_status(server_response, 200)
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Find all the capabilities for a specific user
     capabilities = parsed_response.findall('.//t:granteeCapabilities', namespaces=xmlns)
@@ -219,12 +268,12 @@ def query_permission(server, auth_token, site_id, workbook_id, user_id):
     raise LookupError(error)
 
 
-def delete_permission(server, auth_token, site_id, workbook_id, user_id, permission_name, existing_mode):
+def delete_permission(session, server, site_id, workbook_id, user_id, permission_name, existing_mode):
     """
     Deletes a specific permission from the workbook.
 
+    'session'           session used to make requests to the server
     'server'            specified server address
-    'auth_token'        authentication token that grants user access to API calls
     'site_id'           ID of the site that the user is signed into
     'workbook_id'       ID of workbook to audit permission in
     'user_id'           ID of the user to audit
@@ -237,17 +286,17 @@ def delete_permission(server, auth_token, site_id, workbook_id, user_id, permiss
                                                                                            user_id,
                                                                                            permission_name,
                                                                                            existing_mode)
-    server_response = requests.delete(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.delete(url)
     _check_status(server_response, 204)
     return
 
 
-def add_new_permission(server, auth_token, site_id, workbook_id, user_id, permission_name, permission_mode):
+def add_new_permission(session, server, site_id, workbook_id, user_id, permission_name, permission_mode):
     """
     Adds the specified permission to the workbook for the desired user.
 
+    'session'           session used to make requests to the server
     'server'            specified server address
-    'auth_token'        authentication token that grants user access to API calls
     'site_id'           ID of the site that the user is signed into
     'workbook_id'       ID of workbook to audit permission in
     'user_id'           ID of the user to audit
@@ -257,16 +306,10 @@ def add_new_permission(server, auth_token, site_id, workbook_id, user_id, permis
     url = server + "/api/{0}/sites/{1}/workbooks/{2}/permissions".format(VERSION, site_id, workbook_id)
 
     # Build the request
-    xml_request = ET.Element('tsRequest')
-    permissions_element = ET.SubElement(xml_request, 'permissions')
-    ET.SubElement(permissions_element, 'workbook', id=workbook_id)
-    grantee_element = ET.SubElement(permissions_element, 'granteeCapabilities')
-    ET.SubElement(grantee_element, 'user', id=user_id)
-    capabilities_element = ET.SubElement(grantee_element, 'capabilities')
-    ET.SubElement(capabilities_element, 'capability', name=permission_name, mode=permission_mode)
-    xml_request = ET.tostring(xml_request)
-
-    server_request = requests.put(url, data=xml_request, headers={'x-tableau-auth': auth_token})
+    xml_request = PERMISSION_TEMPLATE.format(quoteattr(workbook_id), quoteattr(user_id),
+                                             quoteattr(permission_name), quoteattr(permission_mode)).encode('utf-8')
+
+    server_request = session.put(url, data=xml_request)
     _check_status(server_request, 200)
     print("\tSuccessfully added/updated permission")
     return
@@ -297,19 +340,20 @@ def main():
 
     ##### STEP 1: Sign in #####
     print("\n1. Signing in as " + server_username)
-    auth_token, site_id, user_id = sign_in(server, server_username, password)
+    session = _make_session()
+    site_id, user_id = sign_in(session, server, server_username, password)
 
     ##### STEP 2: Find id of username to audit #####
     print("\n2. Finding user id of {0}".format(username_to_audit))
-    user_id = get_user_id(server, auth_token, site_id, username_to_audit)
+    user_id = get_user_id(session, server, site_id, username_to_audit)
 
     ##### STEP 3: Find workbook id #####
     print("\n3. Finding workbook id of '{0}'".format(workbook_name))
-    workbook_id = get_workbook_id(server, auth_token, user_id, site_id, workbook_name)
+    workbook_id = get_workbook_id(session, server, user_id, site_id, workbook_name)
 
     ##### STEP 4: Query permissions #####
     print("\n4. Querying all permissions for workbook")
-    user_permissions = query_permission(server, auth_token, site_id, workbook_id, user_id)
+    user_permissions = query_permission(session, server, site_id, workbook_id, user_id)
 
     ##### STEP 5: Check if permission already exists and delete is set to 'Deny' #####
     print("\n5. Checking if permission already exists and deleting if mode differs")
@@ -319,7 +363,7 @@ def main():
             if permission.get('mode') != permission_mode:
                 print("\tDeleting existing permission")
                 existing_mode = permission.get('mode')
-                delete_permission(server, auth_token, site_id, workbook_id,
+                delete_permission(session, server, site_id, workbook_id,
                                   user_id, permission_name, existing_mode)
             else:
                 update_permission = False
@@ -327,14 +371,14 @@ def main():
     ##### STEP 6: Add the desired permission set to 'Allow' if it doesn't already exist #####
     print("\n6. Adding desired permission")
     if update_permission:
-        add_new_permission(server, auth_token, site_id, workbook_id,
+        add_new_permission(session, server, site_id, workbook_id,
                            user_id, permission_name, permission_mode)
     else:
         print("\tPermission already set to {0}".format(permission_mode))
 
     ##### STEP 7: Sign out #####
     print("\n7. Signing out and invalidating the authentication token")
-    sign_out(server, auth_token)
+    sign_out(session, server)
 
 
 if __name__ == "__main__":
@@ -19,16 +19,33 @@
 # The file version.py must be in the local folder with the correct API version number
 """
 
-import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+try:
+    from lxml import etree as ET # Contains methods used to build and parse XML (libxml2-backed)
+except ImportError:
+    import xml.etree.ElementTree as ET # Falls back to the standard library parser
 import sys
 import getpass
+from multiprocessing.pool import ThreadPool # Thread-backed pool, available on Python 2.7 and 3
+from xml.sax.saxutils import quoteattr # Escapes values placed in XML attributes
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote  # Python 2.7
 import requests # Contains methods used to make HTTP requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from version import VERSION
 
 # The namespace for the REST API is 'http://tableausoftware.com/api' for Tableau Server 9.0
 # or 'http://tableau.com/api' for Tableau Server 9.1 or later
 XMLNS = {'t': 'http://tableau.com/api'}
 
+# Request body templates
+SIGN_IN_TEMPLATE = '<tsRequest><credentials name={0} password={1}><site contentUrl={2}/></credentials></tsRequest>'
+
+# Number of pages of users requested from the server at the same time
+PAGE_WORKERS = 8
+
 # If using python version 3.x, 'raw_input()' is changed to 'input()'
 if sys.version[0] == '3': raw_input=input
 
@@ -43,7 +60,8 @@ class UserDefinedFieldError(Exception):
 def _encode_for_display(text):
     """
     Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
+    Responses are parsed from their raw bytes, so this is only needed for text
+    that is shown to the user.
 
     Returns an ASCII-encoded version of the text.
     Unicode characters are converted to ASCII placeholders (for example, "?").
@@ -59,7 +77,7 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        parsed_response = ET.fromstring(server_response.content)
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=XMLNS)
@@ -71,13 +89,28 @@ def _check_status(server_response, success_code):
         summary = summary_element.text if summary_element is not None else 'unknown summary'
         detail = detail_element.text if detail_element is not None else 'unknown detail'
         error_message = '{0}: {1} - {2}'.format(code, summary, detail)
-        raise ApiCallError(error_message)
+        raise ApiCallError(_encode_for_display(error_message))
     return
 
-def sign_in(server, username, password, site):
+def _make_session():
+    """
+    Creates a session that reuses its connections to the server,
+    keeping one for each of the PAGE_WORKERS threads.
+    Returns the new session.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PAGE_WORKERS, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def sign_in(session, server, username, password, site):
     """
     Signs in to the server specified with the given credentials
 
+    'session'  session used to make requests to the server
     'server'   specified server address
     'username' is the name (not ID) of the user to sign in as.
                Note that most of the functions in this example require that the user
@@ -85,109 +118,104 @@ def sign_in(server, username, password, site):
     'password' is the password for the user.
     'site'     is the ID (as a string) of the site on the server to sign in to. The
                default is "", which signs in to the default site.
-    Returns the authentication token and the site ID.
+    The authentication token is sent with every later request made through the session.
+    Returns the site ID.
     """
     url = server + "/api/{0}/auth/signin".format(VERSION)
 
     # Builds the request
-    xml_request = ET.Element('tsRequest')
-    credentials_element = ET.SubElement(xml_request, 'credentials', name=username, password=password)
-    ET.SubElement(credentials_element, 'site', contentUrl=site)
-    xml_request = ET.tostring(xml_request)
+    xml_request = SIGN_IN_TEMPLATE.format(quoteattr(username), quoteattr(password), quoteattr(site)).encode('utf-8')
 
     # Make the request to server
-    server_response = requests.post(url, data=xml_request)
+    server_response = session.post(url, data=xml_request)
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Gets the auth token and site ID
-    token = parsed_response.find('t:credentials', namespaces=XMLNS).get('token')
-    site_id = parsed_response.find('.//t:site', namespaces=XMLNS).get('id')
-    # user_id = parsed_response.find('.//t:user', namespaces=XMLNS).get('id')
-    return token, site_id
-
-def sign_out(server, auth_token):
+    credentials_element = parsed_response.find('t:credentials', namespaces=XMLNS)
+    token = credentials_element.get('token')
+    site_id = credentials_element.find('t:site', namespaces=XMLNS).get('id')
+    # user_id = credentials_element.find('t:user', namespaces=XMLNS).get('id')
+    session.headers['x-tableau-auth'] = token
+    return site_id
+
+def sign_out(session, server):
     """
     Destroys the active session and invalidates authentication token.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 204)
+    del session.headers['x-tableau-auth']
     return
 
-def get_group_id(server, auth_token, site_id, group_name):
+def get_groups(session, server, site_id, page_size, group_name=""):
     """
-    Returns the group id for the group name
+    Yields all groups in the site, or only the group named group_name if one is given,
+    requesting each page of groups once the previous one has been used
     """
-    url = server + "/api/{0}/sites/{1}/groups".format(VERSION, site_id)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-
-    groups = xml_response.findall('.//t:group', namespaces=XMLNS)
-    for group in groups:
-        if group.get('name') == group_name:
-            return group.get('id')
-    error = "Group named '{0}' not found.".format(group_name)
-    raise LookupError(error)
-
-
-def query_groups(server, auth_token, site_id, page_size, page_number):
+    # This method counts from 1
+    page_number = 1
+    while True:
+        groups, total_available = query_groups(session, server, site_id, page_size, page_number, group_name)
+        for group in groups:
+            yield group
+        if page_number * page_size >= total_available:
+            return
+        page_number += 1
+
+
+def query_groups(session, server, site_id, page_size, page_number, group_name=""):
     """
-    Queries for all groups in the site
+    Queries for all groups in the site, or only the group named group_name if one is given
     URI GET /api/api-version/sites/site-id/groups
     GET /api/api-version/sites/site-id/groups?pageSize=page-size&pageNumber=page-number
+    GET /api/api-version/sites/site-id/groups?filter=name:eq:group-name
+    Returns the groups on the page and the number of groups available
     """
     if page_size == 0:
         url = server + "/api/{0}/sites/{1}/groups".format(VERSION, site_id)
     else:
         url = server + "/api/{0}/sites/{1}/groups?pageSize={2}&pageNumber={3}".format(VERSION, site_id, page_size, page_number)
 
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
+    # Let the server filter by name, so only the requested group is returned
+    # rather than every group on the site
+    if group_name != "":
+        separator = "?" if page_size == 0 else "&"
+        url += "{0}filter=name:eq:{1}".format(separator, quote(group_name, safe=''))
+
+    server_response = session.get(url)
     _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = ET.fromstring(server_response.content)
     groups = xml_response.findall('.//t:group', namespaces=XMLNS)
-    return groups
+    total_available = int(xml_response.find('.//t:pagination', namespaces=XMLNS).attrib['totalAvailable'])
+    return groups, total_available
 
-def get_users_in_group(server, auth_token, site_id, group_id, page_size, page_number):
+def get_users_in_group(session, server, site_id, group_id, page_size, page_number):
     """
     Get all the users in the group using group id
     GET /api/api-version/sites/site-id/groups/group-id/users
     GET /api/api-version/sites/site-id/groups/group-id/users?pageSize=page-size&pageNumber=page-number
+    Returns the users on the page and the number of users available in the group
     """
     if page_size == 0:
         url = server + "/api/{0}/sites/{1}/groups/{2}/users".format(VERSION, site_id, group_id)
     else:
         url = server + "/api/{0}/sites/{1}/groups/{2}/users?pageSize={3}&pageNumber={4}".format(VERSION, site_id, group_id, page_size, page_number)
 
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
-    #_check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    server_response = session.get(url)
+    _check_status(server_response, 200)
+    xml_response = ET.fromstring(server_response.content)
     users = xml_response.findall('.//t:user', namespaces=XMLNS)
-    return users
-
-def get_users_in_group_count(server, auth_token, site_id, group_id):
-    """
-    Find out how many users are available in the group
-    GET /api/api-version/sites/site-id/groups/group-id/users
-    """
-    url = server + "/api/{0}/sites/{1}/groups/{2}/users".format(VERSION, site_id, group_id)
-
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
-    #_check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
     total_available = xml_response.find('.//t:pagination', namespaces=XMLNS).attrib['totalAvailable']
     # Note! Need to convert "total_available" to integer
     total_available = int(total_available)
-    return total_available
+    return users, total_available
 
 def main():
     """
@@ -205,7 +233,7 @@ def main():
     password = ""
     site_id = ""
     group_name = ""
-    page_size = 100
+    page_size = 1000   # Largest page size the REST API allows, to keep round trips down
 
     if len(sys.argv) > 1:
         server = sys.argv[1]
@@ -231,10 +259,6 @@ def main():
     if group_name == "":
         group_name = raw_input("\nGroup name (hit Return for all groups): ")
 
-    # Prompt for page size
-    if page_size == "":
-        page_size = int(raw_input("\nPage size: "))
-
     # Fix up the site id and group name - blank indicates default value
     if site_id == "Default":
         site_id = ""
@@ -243,39 +267,46 @@ def main():
         group_name = ""
 
     print("\nSigning in to obtain authentication token")
-    auth_token, site_id = sign_in(server, username, password, site_id)
-
-    total_available = 0
-    total_returned = 0
+    session = _make_session()
+    site_id = sign_in(session, server, username, password, site_id)
 
-    # get all the groups in the site
-    groups = query_groups(server, auth_token, site_id, 0, 0)
+    # get the requested group, or page through all the groups in the site
+    groups = get_groups(session, server, site_id, page_size, group_name)
 
-    for group in groups:
-        done = False
+    def get_page(page):
+        group_id, page_number = page
+        return get_users_in_group(session, server, site_id, group_id, page_size, page_number)[0]
 
-        # This method counts from 1
-        counter = 1
+    pool = ThreadPool(PAGE_WORKERS)
+    try:
+        for group in groups:
+            # Skip other groups before requesting their users
+            if group_name != "" and group.get('name') != group_name:
+                continue
 
-        group_id = group.get('id')
-        total_available = get_users_in_group_count(server, auth_token, site_id, group_id)
+            group_id = group.get('id')
 
-        if group_name != "" and group.get('name') != group_name:
-            continue
+            # The first page also says how many users the group has, so the
+            # remaining pages can then be requested at the same time.
+            # This method counts from 1
+            users, total_available = get_users_in_group(session, server, site_id, group_id, page_size, 1)
+            page_count = (total_available + page_size - 1) // page_size
 
-        print("\nPrinting " + str(total_available) + ' users from the group: ' + group.get('name'))
-        while not done:
-            users = get_users_in_group(server, auth_token, site_id, group_id, page_size, counter)
-            counter += 1
+            print("\nPrinting " + str(total_available) + ' users from the group: ' + _encode_for_display(group.get('name')))
             for user in users:
-                print(user.get('name'))
+                print(_encode_for_display(user.get('name')))
 
-            total_returned = total_returned + page_size
-            if total_returned >= total_available:
-                done = True
+            # map() returns the pages in order, so users print in the same order as before
+            pages = [(group_id, page_number) for page_number in range(2, page_count + 1)]
+            for users in pool.map(get_page, pages):
+                for user in users:
+                    print(_encode_for_display(user.get('name')))
+    finally:
+        pool.close()
+        pool.join()
 
     print("\nSigning out and invalidating the authentication token")
-    sign_out(server, auth_token)
+    sign_out(session, server)
 
 if __name__ == "__main__":
     main()
@@ -20,10 +20,16 @@
 
 from version import VERSION
 import requests # Contains methods used to make HTTP requests
-import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+try:
+    from lxml import etree as ET # Contains methods used to build and parse XML (libxml2-backed)
+except ImportError:
+    import xml.etree.ElementTree as ET # Falls back to the standard library parser
 
 import sys
 import getpass
+from xml.sax.saxutils import quoteattr # Escapes values placed in XML attributes
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from credentials import SERVER, USERNAME, PASSWORD, SITENAME
 
@@ -31,6 +37,9 @@ from credentials import SERVER, USERNAME, PASSWORD, SITENAME
 # or 'http://tableau.com/api' for Tableau Server 9.1 or later
 xmlns = {'t': 'http://tableau.com/api'}
 
+# Request body templates
+SIGN_IN_TEMPLATE = '<tsRequest><credentials name={0} password={1}><site contentUrl={2}/></credentials></tsRequest>'
+
 # If using python version 3.x, 'raw_input()' is changed to 'input()'
 if sys.version[0] == '3': raw_input=input
 
@@ -46,7 +55,8 @@ class UserDefinedFieldError(Exception):
 def _encode_for_display(text):
     """
     Encodes strings so they can display as ASCII in a Windows terminal window.
-    This function also encodes strings for processing by xml.etree.ElementTree functions.
+    Responses are parsed from their raw bytes, so this is only needed for text
+    that is shown to the user.
 
     Returns an ASCII-encoded version of the text.
     Unicode characters are converted to ASCII placeholders (for example, "?").
@@ -63,7 +73,7 @@ def _check_status(server_response, success_code):
     Throws an ApiCallError exception if the API call fails.
     """
     if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+        parsed_response = ET.fromstring(server_response.content)
 
         # Obtain the 3 xml tags from the response: error, summary, and detail tags
         error_element = parsed_response.find('t:error', namespaces=xmlns)
@@ -75,14 +85,29 @@ def _check_status(server_response, success_code):
         summary = summary_element.text if summary_element is not None else 'unknown summary'
         detail = detail_element.text if detail_element is not None else 'unknown detail'
         error_message = '{0}: {1} - {2}'.format(code, summary, detail)
-        raise ApiCallError(error_message)
+        raise ApiCallError(_encode_for_display(error_message))
     return
 
 
-def sign_in(server, username, password, site=""):
+def _make_session():
+    """
+    Creates a session that reuses its connection to the server.
+    Returns the new session.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'], raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def sign_in(session, server, username, password, site=""):
     """
     Signs in to the server specified with the given credentials
 
+    'session'  session used to make requests to the server
     'server'   specified server address
     'username' is the name (not ID) of the user to sign in as.
                Note that most of the functions in this example require that the user
@@ -90,58 +115,56 @@ def sign_in(server, username, password, site=""):
     'password' is the password for the user.
     'site'     is the ID (as a string) of the site on the server to sign in to. The
                default is "", which signs in to the default site.
-    Returns the authentication token and the site ID.
+    The authentication token is sent with every later request made through the session.
+    Returns the site ID and the user ID.
     """
     url = server + "/api/{0}/auth/signin".format(VERSION)
 
     # Builds the request
-    xml_request = ET.Element('tsRequest')
-    credentials_element = ET.SubElement(xml_request, 'credentials', name=username, password=password)
-    ET.SubElement(credentials_element, 'site', contentUrl=site)
-    xml_request = ET.tostring(xml_request)
+    xml_request = SIGN_IN_TEMPLATE.format(quoteattr(username), quoteattr(password), quoteattr(site)).encode('utf-8')
 
     # Make the request to server
-    server_response = requests.post(url, data=xml_request)
+    server_response = session.post(url, data=xml_request)
     _check_status(server_response, 200)
 
-    # ASCII encode server response to enable displaying to console
-    server_response = _encode_for_display(server_response.text)
-
-    # Reads and parses the response
-    parsed_response = ET.fromstring(server_response)
+    # Reads and parses the response from its raw bytes
+    parsed_response = ET.fromstring(server_response.content)
 
     # Gets the auth token and site ID
-    token = parsed_response.find('t:credentials', namespaces=xmlns).get('token')
-    site_id = parsed_response.find('.//t:site', namespaces=xmlns).get('id')
-    user_id = parsed_response.find('.//t:user', namespaces=xmlns).get('id')
-    return token, site_id, user_id
+    credentials_element = parsed_response.find('t:credentials', namespaces=xmlns)
+    token = credentials_element.get('token')
+    site_id = credentials_element.find('t:site', namespaces=xmlns).get('id')
+    user_id = credentials_element.find('t:user', namespaces=xmlns).get('id')
+    session.headers['x-tableau-auth'] = token
+    return site_id, user_id
 
 
-def sign_out(server, auth_token):
+def sign_out(session, server):
     """
     Destroys the active session and invalidates authentication token.
 
+    'session'       session used to make requests to the server
     'server'        specified server address
-    'auth_token'    authentication token that grants user access to API calls
     """
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url)
     _check_status(server_response, 204)
+    del session.headers['x-tableau-auth']
     return
 
 
 
 # webhook specific methods
 
-def list_all_webhooks(server, site, auth_token):
+def list_all_webhooks(session, server, site):
 
     url = server + "/api/{0}/sites/{1}/webhooks".format(VERSION, site)
     print(url)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.get(url)
 
     _check_status(server_response, 200)
     # Gets the auth token and webhook ID
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = ET.fromstring(server_response.content)
     print('-----')
     print(_encode_for_display(server_response.text))
     print('-----')
@@ -149,21 +172,17 @@ def list_all_webhooks(server, site, auth_token):
 
 
 
-def get_webhook_by_id(server, site, auth_token, webhook_id):
+def get_webhook_by_id(session, server, site, webhook_id):
 
     url = server + "/api/{0}/sites/{1}/webhooks/{2}".format(VERSION, site, webhook_id)
     print(url)
 
-    # Build the request to get a webhook
-    xml_request = ET.Element('tsRequest')
-    xml_request = ET.tostring(xml_request)
-    print(xml_request)
-
-    server_response = requests.get(url, data=xml_request, headers={'x-tableau-auth': auth_token})
+    # A GET has no request body, so only the auth header is sent
+    server_response = session.get(url)
     _check_status(server_response, 200)
 
     # Returns a webhook element
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = ET.fromstring(server_response.content)
     print('-----')
     print(_encode_for_display(server_response.text))
     return xml_response.find(".//t:webhook", namespaces=xmlns)
@@ -171,13 +190,13 @@ def get_webhook_by_id(server, site, auth_token, webhook_id):
 
 
 
-def test_webhook(server, site, auth_token, webhook_id):
+def test_webhook(session, server, site, webhook_id):
     url = server + "/api/{0}/sites/{1}/webhooks/{2}/test".format(VERSION, site, webhook_id)
     print(url)
-    server_response = requests.get(url, headers={'x-tableau-auth': auth_token})
+    server_response = session.get(url)
 
     # Gets the auth token and webhook ID
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = ET.fromstring(server_response.content)
     print('-----')
     print(_encode_for_display(server_response.text))
     #print('-----')
@@ -185,7 +204,7 @@ def test_webhook(server, site, auth_token, webhook_id):
 
 
 
-def create_webhook(server, site, auth_token, source_event, webhook_endpoint, webhook_name):
+def create_webhook(session, server, site, source_event, webhook_endpoint, webhook_name):
 
     url = server + "/api/{0}/sites/{1}/webhooks".format(VERSION, site)
     print(url)
@@ -203,21 +222,21 @@ def create_webhook(server, site, auth_token, source_event, webhook_endpoint, web
     xml_request = ET.tostring(xml_request)
     print (xml_request)
 
-    server_response = requests.post(url, data=xml_request, headers={'x-tableau-auth': auth_token})
+    server_response = session.post(url, data=xml_request)
 
     _check_status(server_response, 201)
     # Gets the auth token and webhook ID
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    xml_response = ET.fromstring(server_response.content)
     print ('-----')
     print( _encode_for_display(server_response.text))
     return xml_response.find(".//t:webhook", namespaces=xmlns)
 
 
-def delete_webhook(server, site_id, auth_token, webhook_id):
+def delete_webhook(session, server, site_id, webhook_id):
     url = server + "/api/{0}/sites/{1}/webhooks/{2}".format(VERSION, site_id, webhook_id)
     print("deleting webhook {0} - {1}".format(webhook_id, url))
 
-    server_response = requests.delete(url,  headers={'x-tableau-auth': auth_token})
+    server_response = session.delete(url)
     print (server_response)
     return
 
@@ -246,17 +265,17 @@ datasource_events = [
 
 def delete_all():
 
-    webhook = list_all_webhooks(server, site_id, auth_token)
+    webhook = list_all_webhooks(session, server, site_id)
     print ("webhooks:")
     for item in webhook:
         print(item)
         webhook_id = item.get('id')
-        site = delete_webhook(server, site_id, auth_token, webhook_id)
+        site = delete_webhook(session, server, site_id, webhook_id)
         print("\n3. Deleting webhook {0}".format(webhook_id))
 
 
     print("\nSigning out and invalidating the authentication token")
-    sign_out(server, auth_token)
+    sign_out(session, server)
 
 
 
@@ -272,35 +291,36 @@ def main():
         site_name = ""
 
     ##### STEP 1: Signing in to obtain authentication token
-    auth_token, site_id, user_id = sign_in(server, username, password, site_name)
+    session = _make_session()
+    site_id, user_id = sign_in(session, server, username, password, site_name)
     print("Signed in to site ", site_id)
 
     ##### STEP 2. create a new webhook
     webhook_endpoint = 'https://webhook.site/ef2be372-63ae-4f6b-8613-dccec992117f'
     event = workbook_events[0] # can use any of those defined above
     webhook_name = event + "-webhook-site-automated-test"
-    created_webhook = create_webhook(server, site_id, auth_token, event, webhook_endpoint, webhook_name)
+    created_webhook = create_webhook(session, server, site_id, event, webhook_endpoint, webhook_name)
     webhook_id = created_webhook.get("id")
     print("\n2. Created a webhook {0} with id {1}".format(webhook_name, webhook_id))
 
 
     ##### STEP 3: Find webhook id of newly created item by its id, just for fun
     print("\n3. Finding webhook with id '{0}'".format(webhook_id))
-    webhook = get_webhook_by_id(server, site_id, auth_token, webhook_id)
-    print("\n found webhook with name {0}".format(webhook.get('name')))
+    webhook = get_webhook_by_id(session, server, site_id, webhook_id)
+    print("\n found webhook with name {0}".format(_encode_for_display(webhook.get('name'))))
 
 
     ##### STEP 4: Test the new webhook
-    test_webhook(server, site_id, auth_token, webhook_id)
+    test_webhook(session, server, site_id, webhook_id)
 
 
     ##### STEP 5: delete the webhook
-    site = delete_webhook(server, site_id, auth_token, webhook_id)
+    site = delete_webhook(session, server, site_id, webhook_id)
     print("\n3. Deleting new webhook")
 
 
     print("\nSigning out and invalidating the authentication token")
-    sign_out(server, auth_token)
+    sign_out(session, server)
 
 if __name__ == "__main__":
     main()